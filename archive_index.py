@@ -0,0 +1,207 @@
+import os
+import sys
+import json
+import bisect
+import tarfile
+import argparse
+import stat
+from concurrent.futures import ThreadPoolExecutor
+from compression import get_codec
+from file_tree import get_matcher, get_restore_path
+
+ARCHIVE_INDEX_EXTENSION = '.index'
+BLOCK_SIZE = 4 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Indexed Archives')
+    commands = parser.add_subparsers(dest='command', required=True)
+    list_parser = commands.add_parser('list', help='List the members of an archive')
+    list_parser.add_argument('-a', '--archive', required=True, help='Archive written with --seekable')
+    restore_parser = commands.add_parser('restore', help='Restore members of an archive')
+    restore_parser.add_argument('-a', '--archive', required=True, help='Archive written with --seekable')
+    restore_parser.add_argument('-d', '--destination', required=True, help='Restore destination directory')
+    restore_parser.add_argument('paths', nargs='+', help='Files or folders to restore')
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit()
+
+    return parser.parse_args()
+
+
+def _padded(size):
+    return -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+
+# Member table of an archive and the (compressed offset, tar offset) where
+# each independently compressed block starts. Members point at the tar
+# offset of their data, so a restore only decompresses from the block that
+# holds it. Kept in a sidecar file next to the archive
+class ArchiveIndex:
+    def __init__(self, codec, members=(), blocks=()):
+        self.codec = codec
+        self.members = list(members)
+        self.blocks = [tuple(block) for block in blocks]
+        self.saved_members = len(self.members)
+        self.saved_blocks = len(self.blocks)
+
+    def add_block(self, offset, position):
+        self.blocks.append((offset, position))
+
+    def add(self, info, offset):
+        size = info.size if info.isreg() else 0
+        self.members.append({'name': info.name, 'type': info.type.decode('ascii'), 'size': size,
+                             'offset': offset - _padded(size), 'mode': info.mode & 0o7777,
+                             'mtime': info.mtime, 'target': info.linkname})
+
+    # Members and blocks added since the last call, saved with checkpoints
+    def get_changes(self):
+        changes = {'members': self.members[self.saved_members:], 'blocks': self.blocks[self.saved_blocks:]}
+        self.saved_members = len(self.members)
+        self.saved_blocks = len(self.blocks)
+        return changes
+
+    def save(self, path):
+        index = {'format': 1, 'codec': self.codec, 'blocks': self.blocks, 'members': self.members}
+        with open(path + '.tmp', 'w') as f:
+            json.dump(index, f, separators=(',', ':'))
+        os.replace(path + '.tmp', path)
+
+
+def get_index_path(archive):
+    return archive + ARCHIVE_INDEX_EXTENSION
+
+
+def load_index(archive):
+    try:
+        with open(get_index_path(archive), 'r') as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        raise ValueError(f'\'{archive}\' has no index, write it with --seekable')
+    return ArchiveIndex(index['codec'], index['members'], index['blocks'])
+
+
+def find_block(blocks, position):
+    return blocks[bisect.bisect_right([block[1] for block in blocks], position) - 1]
+
+
+def get_mtime_ns(mtime):
+    return int(round(mtime * 1000000000))
+
+
+def is_restored(path, member):
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return False
+    return stat.S_ISREG(st.st_mode) and st.st_size == member['size'] and st.st_mtime_ns == get_mtime_ns(member['mtime'])
+
+
+def set_metadata(path, member):
+    os.chmod(path, member['mode'])
+    mtime_ns = get_mtime_ns(member['mtime'])
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def _skip(stream, size, archive):
+    while size > 0:
+        data = stream.read(min(size, READ_SIZE))
+        if not data:
+            raise EOFError(f'\'{archive}\' is truncated')
+        size -= len(data)
+
+
+# Decompress from the start of one block, writing the given (data member,
+# member, path) files in archive order. Members may run into later blocks
+def extract_block(archive, index, block, files):
+    offset, position = block
+    with open(archive, 'rb') as f:
+        f.seek(offset)
+        with get_codec(index.codec).read(f) as stream:
+            for source, member, path in files:
+                _skip(stream, source['offset'] - position, archive)
+                remaining = source['size']
+                with open(path, 'wb') as out:
+                    while remaining > 0:
+                        data = stream.read(min(remaining, READ_SIZE))
+                        if not data:
+                            raise EOFError(f'\'{archive}\' is truncated')
+                        out.write(data)
+                        remaining -= len(data)
+                position = source['offset'] + source['size']
+                set_metadata(path, member)
+    return len(files)
+
+
+def select_members(index, paths=None, include=None, exclude=None):
+    matcher = get_matcher(include, exclude)
+    if paths:
+        paths = [path.replace(os.sep, '/').strip('/') for path in paths]
+    return [member for member in index.members
+            if (not paths or any(member['name'] == path or member['name'].startswith(path + '/') for path in paths)) and
+            matcher.selects(member['name'], member['type'] == tarfile.DIRTYPE.decode())]
+
+
+# Restore the selected members, files are grouped by the block their data
+# starts in and the groups are decompressed in parallel. Unless forced,
+# files that already match the member's size and mtime are left alone
+def restore_members(archive, paths, target, jobs=1, include=None, exclude=None, force=True):
+    index = load_index(archive)
+    members = {member['name']: member for member in index.members}
+    directories = []
+    blocks = {}
+    restored = 0
+    for member in select_members(index, paths, include, exclude):
+        kind = member['type'].encode('ascii')
+        try:
+            d = get_restore_path(target, member['name'], member['target'] if kind == tarfile.SYMTYPE else None)
+            if kind == tarfile.LNKTYPE:
+                get_restore_path(target, member['target'])
+        except ValueError as e:
+            print(f'Skipping \'{member["name"]}\': {e}')
+            continue
+        os.makedirs(os.path.dirname(d), exist_ok=True)
+        source = member
+        if kind == tarfile.DIRTYPE:
+            os.makedirs(d, exist_ok=True)
+            directories.append((member, d))
+            continue
+        elif kind == tarfile.SYMTYPE:
+            if os.path.lexists(d):
+                os.remove(d)
+            os.symlink(member['target'], d)
+            restored += 1
+            continue
+        elif kind == tarfile.LNKTYPE:
+            # Hard links only name the member holding the data
+            source = members[member['target']]
+        elif kind not in tarfile.REGULAR_TYPES:
+            # Devices and fifos
+            continue
+        if not force and is_restored(d, source):
+            continue
+        blocks.setdefault(find_block(index.blocks, source['offset']), []).append((source, member, d))
+    with ThreadPoolExecutor(max_workers=max(1, jobs), thread_name_prefix='restore') as executor:
+        futures = [executor.submit(extract_block, archive, index, block, sorted(files, key=lambda file: file[0]['offset']))
+                   for block, files in blocks.items()]
+        restored += sum(future.result() for future in futures)
+    # Directories last so writing their children doesn't touch their mtime
+    for member, d in reversed(directories):
+        set_metadata(d, member)
+    return restored
+
+
+def main():
+    args = parse_args()
+    if args.command == 'list':
+        for member in load_index(args.archive).members:
+            print(member['name'])
+    else:
+        restored = restore_members(args.archive, args.paths, args.destination)
+        print(f'Restored {restored} files from \'{args.archive}\'')
+
+
+if __name__ == '__main__':
+    main()
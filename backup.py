@@ -1,19 +1,44 @@
 import os
 import sys
 import argparse
+import stat
 import shutil
-import tarfile
+import time
+from file_tree import scan_tree, scan_tree_sorted, get_scanner, get_last_modified, find_newer, copy_stat, add_to_tar
+from compression import open_archive, available_codecs, get_extension, ARCHIVE_EXTENSIONS
+from checkpoint import PARTIAL_EXTENSION
+from copy_engine import CopyScheduler, DeltaStats, copy_file, copy_symlink, delta_copy, prune_tree, prefetch, DELTA_MIN_SIZE
+from file_index import FileIndex, INDEX_NAME
+from checksum import new_hasher, get_digest, hash_file
+from metrics import BackupStats, report_progress, profiled
+from throttle import add_throttle_arguments, throttle_from_args, throttled
+from journal import ChangeTracker, scan_changes
 
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Backup Files')
     parser.add_argument('-d', '--destination', required=True, help='Backup destination directory')
     parser.add_argument('-s', '--source', required=True, help='Backup source file/folder')
-    parser.add_argument('-i', '--include', nargs='+', help='Files to transfer')
-    parser.add_argument('-e', '--exclude', nargs='+', help='Files to ignore')
+    parser.add_argument('-i', '--include', nargs='+', help='Files to transfer (path prefixes or globs, ! negates)')
+    parser.add_argument('-e', '--exclude', nargs='+', help='Files to ignore (path prefixes or globs, ! negates)')
     parser.add_argument('-c', '--compress', action='store_true', default=False, help='Should compress source')
+    parser.add_argument('--codec', choices=available_codecs(), default='gz', help='Compression codec')
+    parser.add_argument('--level', type=int, default=None, help='Compression level')
     parser.add_argument('-t', '--trees', action='store_true', default=False, help='Remove deleted files in destination')
     parser.add_argument('-f', '--force', action='store_true', default=False, help='Skip checking for changes')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of parallel copy or compression workers')
+    parser.add_argument('--delta', action='store_true', default=False, help='Only rewrite changed blocks of large files')
+    parser.add_argument('--delta-min-size', type=int, default=DELTA_MIN_SIZE // 1048576, help='Minimum file size in MB for delta transfer')
+    parser.add_argument('--index', action='store_true', default=False, help='Detect changes using an index stored in the destination')
+    parser.add_argument('--checksum', action='store_true', default=False, help='Detect changes by content hash, implies --index')
+    parser.add_argument('--low-memory', action='store_true', default=False,
+                        help='Walk directories in sorted order with bounded memory, spilling huge listings to disk')
+    parser.add_argument('--journal', default=None,
+                        help='Only visit directories changed since the last run, as recorded by a journal.py watcher or found by directory mtimes')
+    parser.add_argument('--stats-json', default=None, help='Write file counts, bytes and phase times to this JSON file')
+    parser.add_argument('--profile', default=None, help='Write cProfile stats of the run to this file')
+    parser.add_argument('--trace-memory', action='store_true', default=False, help='Print the peak memory and largest allocations')
+    add_throttle_arguments(parser)
 
     if len(sys.argv) == 1:
         parser.print_help()
@@ -22,12 +47,6 @@ def parse_args():
     return parser.parse_args()
 
 
-def get_last_modified(directory, include, exclude):
-    list_of_files = get_file_tree(directory, '', include, exclude)
-    latest_file = max(list_of_files, key=lambda fn: os.path.getmtime(os.path.join(directory, fn)), default=0)
-    return os.stat(os.path.join(directory, latest_file)).st_mtime
-
-
 def is_newer(source_time, destination_time):
     return source_time - destination_time > 2
 
@@ -40,44 +59,89 @@ def has_file_changed(source, destination):
     return is_newer(os.stat(source).st_mtime, os.stat(destination).st_mtime)
 
 
-def transfer_file(source, destination):
+def has_entry_changed(entry, destination, index=None):
+    if index is not None:
+        return index.has_changed(entry)
     try:
-        if os.path.isdir(source):
-            if not os.path.exists(destination):
-                os.mkdir(destination)
-                shutil.copystat(source, destination)
-        else:
-            shutil.copy2(source, destination)
+        # Dangling symlinks are copied as links
+        destination_time = os.lstat(destination).st_mtime
     except FileNotFoundError:
-        os.makedirs(os.path.dirname(destination))
-        transfer_file(source, destination)
+        return True
+    return is_newer(entry.mtime, destination_time)
 
 
-def should_copy(file_name, include=None, exclude=None):
-    if include:
-        for include_item in include:
-            if file_name.startswith(include_item):
-                return True
+# Files whose stat matches their index record are unchanged without being
+# read. Otherwise the source is hashed and compared to the hash recorded
+# when it was copied, touched but identical files only get their times fixed
+def has_content_changed(entry, destination, index, stats=None):
+    record = index.get(entry.name)
+    if record is None or record.hash is None or record.size != entry.size:
+        return True
+    if record.matches(entry.stat):
         return False
-
-    if exclude:
-        for exclude_item in exclude:
-            if file_name.startswith(exclude_item):
-                return False
+    if stats is not None:
+        stats.add(bytes_read=entry.size)
+    try:
+        digest = hash_file(entry.path)
+    except FileNotFoundError:
+        # Deleted since the scan, copy_entry skips it
+        return True
+    if digest != record.hash:
         return True
+    try:
+        copy_stat(entry.stat, destination)
+    except FileNotFoundError:
+        return True
+    index.update(entry, record.hash)
+    return False
 
-    return True
+
+def transfer_file(source, destination, st=None, hasher=None):
+    if st is None:
+        st = os.stat(source)
+    try:
+        if stat.S_ISDIR(st.st_mode):
+            if not os.path.exists(destination):
+                os.mkdir(destination)
+                copy_stat(st, destination)
+        elif stat.S_ISLNK(st.st_mode):
+            copy_symlink(source, destination, st)
+        else:
+            copy_file(source, destination, st, hasher)
+    except FileNotFoundError:
+        parent = os.path.dirname(destination)
+        if os.path.isdir(parent) or not os.path.lexists(source):
+            raise
+        os.makedirs(parent, exist_ok=True)
+        transfer_file(source, destination, st, hasher)
 
 
-def get_file_tree(directory, base, include=None, exclude=None, update_dirs=False):
-    for item in os.listdir(directory):
-        s = os.path.join(base, item)
-        if should_copy(s, include, exclude):
-            yield s
-            if os.path.isdir(os.path.join(directory, item)):
-                yield from get_file_tree(os.path.join(directory, item), s, include, exclude, update_dirs)
-                if update_dirs:
-                    yield s
+def copy_entry(entry, destination, index=None, delta=None, checksum=False, stats=None):
+    written = None
+    # The hash is taken from the copied data, the file isn't read again
+    hasher = new_hasher() if checksum else None
+    if delta is not None and entry.size >= delta.min_size:
+        try:
+            written = delta_copy(entry.path, destination, entry.stat, hasher=hasher)
+            delta.add(entry.size, written)
+        except FileNotFoundError:
+            pass
+    if written is None:
+        try:
+            transfer_file(entry.path, destination, entry.stat, hasher)
+        except FileNotFoundError:
+            if os.path.lexists(entry.path):
+                raise
+            # Deleted since the scan, the next run removes it with --trees
+            if stats is not None:
+                stats.add(files_vanished=1)
+            return None
+        written = entry.size
+    if index is not None:
+        index.update(entry, get_digest(hasher) if hasher is not None else None)
+    if stats is not None:
+        stats.add(bytes_read=entry.size)
+    return written
 
 
 def print_progress(header, status, is_end=False):
@@ -89,74 +153,161 @@ def print_backup_state(file, status, is_end=False):
     print_progress('Backing up ' + '\'' + file + '\'', status, is_end)
 
 
-def backup(source, destination, include=None, exclude=None, compress=False, compare_trees=False, force=False):
+def backup(source, destination, include=None, exclude=None, compress=False, compare_trees=False, force=False, jobs=1, use_index=False, codec='gz', level=None, delta=False, delta_min_size=DELTA_MIN_SIZE, index=None,
+           checksum=False, stats=None, low_memory=False, journal=None):
     print_backup_state(source, 'WORKING')
     if not os.path.exists(source):
         print_backup_state(source, 'NOT FOUND', True)
         return
+    if stats is None:
+        stats = BackupStats()
 
     if not os.path.exists(destination):
         os.makedirs(destination)
 
     if os.path.isdir(source):
         if compress:
-            destination_compressed = os.path.join(destination, os.path.basename(source) + '.tgz')
-            last_modified = get_last_modified(source, include, exclude)
-            if force or not os.path.exists(destination_compressed) or is_newer(last_modified, os.stat(destination_compressed).st_mtime):
-                tar = tarfile.open(destination_compressed, 'w')
-                for file_item in get_file_tree(source, '', include, exclude):
-                    tar.add(os.path.join(source, file_item), arcname=file_item, recursive=False)
-                tar.close()
+            destination_compressed = os.path.join(destination, os.path.basename(source) + get_extension(codec))
+            if low_memory:
+                # Nothing is listed up front, the check stops at the first newer entry
+                entries = stats.scan(scan_tree_sorted(source, '', include, exclude))
+                changed = force or not os.path.exists(destination_compressed) or \
+                    find_newer(source, os.stat(destination_compressed).st_mtime + 2, include, exclude) is not None
+            else:
+                entries = list(stats.scan(scan_tree(source, '', include, exclude)))
+                last_modified = get_last_modified(entries)
+                changed = force or not os.path.exists(destination_compressed) or \
+                    is_newer(last_modified, os.stat(destination_compressed).st_mtime)
+            if changed:
+                # Written under a temporary name, an interrupted run never
+                # leaves a truncated archive that looks up to date
+                partial = destination_compressed + PARTIAL_EXTENSION
+                try:
+                    with report_progress(stats, lambda status: print_backup_state(source, status)), stats.timed('compress'):
+                        with open_archive(partial, codec, level, jobs) as tar:
+                            for entry in entries:
+                                add_to_tar(tar, entry)
+                                if not entry.is_dir:
+                                    stats.add(files_copied=1, bytes_read=entry.size)
+                    os.replace(partial, destination_compressed)
+                except BaseException:
+                    if os.path.exists(partial):
+                        os.remove(partial)
+                    raise
+                stats.add(bytes_written=os.path.getsize(destination_compressed))
                 # Windows doesn't parse time data correctly
                 # os.utime(destination_compressed, (last_modified, last_modified))
                 print_backup_state(source, 'DONE', True)
             else:
+                stats.add(files_skipped=stats.counters['files_scanned'])
                 print_backup_state(source, 'UP TO DATE', True)
         else:
+            # An index passed in is owned by the caller, it is flushed but left open
+            opened = FileIndex(destination) if (use_index or checksum) and index is None else None
+            if opened is not None:
+                index = opened
             if compare_trees:
-                for file_item in get_file_tree(destination, '', None, None):
-                    if not os.path.exists(os.path.join(source, file_item)) or not should_copy(file_item, include, exclude):
-                        d = os.path.join(destination, file_item)
-                        if os.path.isdir(d):
-                            shutil.rmtree(d)
+                removed = prune_tree(source, destination, include, exclude, jobs, (INDEX_NAME,))
+                for name, is_dir in removed:
+                    if index is not None:
+                        index.remove(name, is_dir)
+                stats.add(files_deleted=len(removed))
+            delta_stats = DeltaStats(delta_min_size) if delta else None
+            scheduler = CopyScheduler(jobs, stats=stats)
+            tracker = ChangeTracker(source, journal) if journal else None
+            if tracker is not None:
+                entries = scan_changes(source, tracker.read(), '', include, exclude, True)
+            else:
+                entries = get_scanner(low_memory)(source, '', include, exclude, True)
+            scheduler.open_directory('', os.stat(source), destination)
+            with report_progress(stats, lambda status: print_backup_state(source, status)):
+                try:
+                    for entry in prefetch(stats.scan(entries)):
+                        d = os.path.join(destination, entry.name)
+                        if entry.is_dir:
+                            if scheduler.is_open(entry.name):
+                                scheduler.close_directory(entry.name)
+                            else:
+                                scheduler.open_directory(entry.name, entry.stat, d)
                         else:
-                            os.remove(d)
-            for file_item in get_file_tree(source, '', include, exclude, True):
-                s = os.path.join(source, file_item)
-                d = os.path.join(destination, file_item)
-                if os.path.isdir(s):
-                    if not os.path.exists(d):
-                        os.makedirs(d)
-                    shutil.copystat(s, d)
+                            args = (entry, d, index, delta_stats, checksum, stats)
+                            if force:
+                                scheduler.submit(entry.name, copy_entry, args)
+                            elif checksum:
+                                scheduler.submit(entry.name, copy_entry, args, has_content_changed, (entry, d, index, stats))
+                            elif index is not None:
+                                # Index lookups are in memory, no need for a check worker
+                                start = time.perf_counter()
+                                changed = index.has_changed(entry)
+                                stats.add_time('decide', time.perf_counter() - start)
+                                if changed:
+                                    scheduler.submit(entry.name, copy_entry, args)
+                                else:
+                                    stats.add(files_skipped=1)
+                            else:
+                                scheduler.submit(entry.name, copy_entry, args, has_entry_changed, (entry, d))
+                except BaseException:
+                    scheduler.cancel()
+                    raise
                 else:
-                    if force or has_file_changed(s, d):
-                        transfer_file(s, d)
-            shutil.copystat(source, destination)
+                    scheduler.wait()
+                finally:
+                    if opened is not None:
+                        opened.close()
+                    elif index is not None:
+                        index.flush()
+                scheduler.close_directory('')
+            if tracker is not None:
+                tracker.commit()
             print_backup_state(source, 'DONE', True)
+            if jobs > 1:
+                scheduler.print_stats()
+            if delta_stats is not None:
+                delta_stats.print_stats()
     else:
         file_name, file_ext = os.path.splitext(source)
-        if compress and file_ext != '.tgz':
-            d = os.path.join(destination, os.path.basename(file_name) + '.tgz')
+        if compress and file_ext not in ARCHIVE_EXTENSIONS:
+            d = os.path.join(destination, os.path.basename(file_name) + get_extension(codec))
             if force or has_file_changed(source, d):
-                tar = tarfile.open(d, 'w')
-                tar.add(source, arcname=os.path.basename(source))
-                tar.close()
+                partial = d + PARTIAL_EXTENSION
+                try:
+                    with stats.timed('compress'):
+                        with open_archive(partial, codec, level, jobs) as tar:
+                            tar.add(source, arcname=os.path.basename(source))
+                    os.replace(partial, d)
+                except BaseException:
+                    if os.path.exists(partial):
+                        os.remove(partial)
+                    raise
                 shutil.copystat(source, d)
+                stats.add(files_scanned=1, files_copied=1, bytes_read=os.path.getsize(source), bytes_written=os.path.getsize(d))
                 print_backup_state(source, 'DONE', True)
             else:
+                stats.add(files_scanned=1, files_skipped=1)
                 print_backup_state(source, 'UP TO DATE', True)
         else:
             d = os.path.join(destination, os.path.basename(source))
             if force or has_file_changed(source, d):
-                transfer_file(source, d)
+                with stats.timed('copy'):
+                    transfer_file(source, d)
+                size = os.path.getsize(d)
+                stats.add(files_scanned=1, files_copied=1, bytes_read=size, bytes_written=size)
                 print_backup_state(source, 'DONE', True)
             else:
+                stats.add(files_scanned=1, files_skipped=1)
                 print_backup_state(source, 'UP TO DATE', True)
+    stats.stop()
 
 
 def main() -> None:
     args = parse_args()
-    backup(args.source, args.destination, args.include, args.exclude, args.compress, args.trees, args.force)
+    stats = BackupStats()
+    with profiled(args.profile, args.trace_memory), throttled(throttle_from_args(args)):
+        backup(args.source, args.destination, args.include, args.exclude, args.compress, args.trees, args.force, args.jobs, args.index,
+               args.codec, args.level, args.delta, args.delta_min_size * 1048576, None, args.checksum, stats,
+               args.low_memory, args.journal)
+    if args.stats_json:
+        stats.save(args.stats_json)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,200 @@
+import os
+import sys
+import json
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import backup
+import backup_version
+from file_tree import DirectoryCache
+from file_index import FileIndex
+from throttle import add_throttle_arguments, throttle_from_args, throttled
+
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
+
+# Job file keys and the backup() arguments they map to, named like the CLI flags
+MIRROR_OPTIONS = {
+    'include': 'include', 'exclude': 'exclude', 'compress': 'compress', 'codec': 'codec', 'level': 'level',
+    'trees': 'compare_trees', 'force': 'force', 'jobs': 'jobs', 'delta': 'delta', 'delta_min_size': 'delta_min_size',
+    'index': 'use_index', 'checksum': 'checksum', 'low_memory': 'low_memory',
+    'journal': 'journal',
+}
+VERSION_OPTIONS = {
+    'name': 'name', 'include': 'include', 'exclude': 'exclude', 'compress': 'compress', 'codec': 'codec',
+    'level': 'level', 'jobs': 'jobs', 'link': 'link', 'dedup': 'dedup', 'prune_dirs': 'prune_dirs', 'force': 'force',
+    'resume': 'resume', 'checkpoint_interval': 'checkpoint_interval', 'seekable': 'seekable',
+    'keep_last': 'keep_last', 'keep_hourly': 'keep_hourly', 'keep_daily': 'keep_daily', 'keep_weekly': 'keep_weekly',
+    'incremental': 'incremental', 'full_every': 'full_every', 'low_memory': 'low_memory',
+    'journal': 'journal',
+}
+JOB_TYPES = {'mirror': MIRROR_OPTIONS, 'version': VERSION_OPTIONS}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Run Backup Jobs')
+    parser.add_argument('-f', '--file', required=True, help='Job file (.json or .toml)')
+    parser.add_argument('-p', '--parallel', type=int, default=None, help='Number of jobs run at once')
+    parser.add_argument('--device-jobs', type=int, default=None, help='Number of jobs reading or writing a device at once')
+    parser.add_argument('-o', '--only', nargs='+', help='Names of the jobs to run')
+    add_throttle_arguments(parser)
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit()
+
+    return parser.parse_args()
+
+
+class Job:
+    __slots__ = ('name', 'type', 'source', 'destination', 'options')
+
+    def __init__(self, name, type, source, destination, options):
+        self.name = name
+        self.type = type
+        self.source = source
+        self.destination = destination
+        self.options = options
+
+
+# A job file holds a list of jobs, each a table with a source, a destination,
+# a type ('mirror' or 'version') and the options of that CLI. Options in the
+# top level 'defaults' table apply to every job
+def load_jobs(path):
+    if path.endswith('.toml'):
+        if tomllib is None:
+            raise ValueError('TOML job files need Python 3.11 or later')
+        with open(path, 'rb') as f:
+            config = tomllib.load(f)
+    else:
+        with open(path, 'r') as f:
+            config = json.load(f)
+    if isinstance(config, list):
+        config = {'jobs': config}
+
+    defaults = config.get('defaults', {})
+    jobs = []
+    for i, table in enumerate(config.get('jobs', [])):
+        table = {**defaults, **table}
+        name = table.pop('job', None) or f'job {i + 1}'
+        type = table.pop('type', 'mirror')
+        if type not in JOB_TYPES:
+            raise ValueError(f'Unknown type \'{type}\' for {name}')
+        try:
+            source = table.pop('source')
+            destination = table.pop('destination')
+        except KeyError as e:
+            raise ValueError(f'Missing {e.args[0]} for {name}')
+        options = {}
+        for key, value in table.items():
+            if key not in JOB_TYPES[type]:
+                raise ValueError(f'Unknown option \'{key}\' for {name}')
+            options[JOB_TYPES[type][key]] = value
+        if 'delta_min_size' in options:
+            options['delta_min_size'] *= 1048576
+        if type == 'version':
+            options.setdefault('compress', False)
+        jobs.append(Job(name, type, source, destination, options))
+    return jobs, config.get('parallel', 1), config.get('device_jobs', 1)
+
+
+def get_device(path):
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return os.stat(path).st_dev
+
+
+# Runs jobs on a shared pool. A job holds a slot on the device of its source
+# and of its destination while it runs, and jobs writing to the same
+# destination run one at a time. Destination indexes and directory caches
+# are opened once and shared by every job that uses them
+class JobRunner:
+    def __init__(self, parallel=1, device_jobs=1):
+        self.parallel = max(1, parallel)
+        self.device_jobs = max(1, device_jobs)
+        self.lock = threading.Lock()
+        self.semaphores = {}
+        self.indexes = {}
+        self.caches = {}
+
+    def _get_semaphore(self, key, size):
+        with self.lock:
+            if key not in self.semaphores:
+                self.semaphores[key] = threading.Semaphore(size)
+            return self.semaphores[key]
+
+    def _get_shared(self, shared, key, create):
+        with self.lock:
+            if key not in shared:
+                shared[key] = create()
+            return shared[key]
+
+    def run_job(self, job):
+        destination = os.path.abspath(job.destination)
+        options = dict(job.options)
+        if job.type == 'mirror':
+            if (options.pop('use_index', False) or options.get('checksum')) and not options.get('compress'):
+                os.makedirs(destination, exist_ok=True)
+                options['index'] = self._get_shared(self.indexes, destination, lambda: FileIndex(destination))
+            backup.backup(job.source, job.destination, **options)
+        else:
+            if options.get('prune_dirs'):
+                basename = options.get('name') or os.path.basename(os.path.normpath(job.source))
+                path = backup_version.get_directory_cache_path(destination, basename)
+                options['cache'] = self._get_shared(self.caches, path, lambda: DirectoryCache(path))
+            backup_version.backup(job.source, job.destination, **options)
+
+    def _run(self, job):
+        # Sorted so jobs sharing devices always acquire them in the same order
+        keys = sorted({('device', get_device(job.source)), ('device', get_device(job.destination))})
+        slots = [self._get_semaphore(key, self.device_jobs) for key in keys]
+        slots.append(self._get_semaphore(('destination', os.path.abspath(job.destination)), 1))
+        for slot in slots:
+            slot.acquire()
+        try:
+            self.run_job(job)
+        finally:
+            for slot in reversed(slots):
+                slot.release()
+
+    def run(self, jobs):
+        failed = []
+        try:
+            with ThreadPoolExecutor(max_workers=self.parallel, thread_name_prefix='job') as executor:
+                futures = [(job, executor.submit(self._run, job)) for job in jobs]
+                for job, future in futures:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f'Failed {job.name}: {e}')
+                        failed.append(job)
+        finally:
+            self.close()
+        return failed
+
+    def close(self):
+        for index in self.indexes.values():
+            index.close()
+        self.indexes.clear()
+        self.caches.clear()
+
+
+def main():
+    args = parse_args()
+    jobs, parallel, device_jobs = load_jobs(args.file)
+    if args.only:
+        jobs = [job for job in jobs if job.name in args.only]
+    runner = JobRunner(args.parallel or parallel, args.device_jobs or device_jobs)
+    # One limit for all jobs together
+    with throttled(throttle_from_args(args)):
+        failed = runner.run(jobs)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,20 @@
 import os
 import sys
 import argparse
+import stat
 import shutil
-import tarfile
+import time
+from file_tree import get_scanner, find_newer, copy_stat, add_to_tar, DirectoryCache, DIRECTORY_CACHE_EXTENSION
+from compression import open_archive, available_codecs, get_extension
+from copy_engine import CopyScheduler, copy_file, copy_symlink, prefetch
+from chunk_store import write_snapshot, MANIFEST_EXTENSION
+from archive_index import ArchiveIndex, get_index_path, BLOCK_SIZE
+from checkpoint import Checkpoint, load_checkpoint, PARTIAL_EXTENSION, CHECKPOINT_EXTENSION, CHECKPOINT_INTERVAL
+from retention import VersionCatalog, RetentionPolicy, get_version_pattern, prune
+from metrics import BackupStats, report_progress, profiled
+from incremental import start_snapshot, FULL_EVERY
+from throttle import add_throttle_arguments, throttle_from_args, throttled
+from journal import ChangeTracker
 from datetime import datetime
 
 
@@ -10,11 +22,37 @@ def parse_args():
     parser = argparse.ArgumentParser(description='Backup Projects')
     parser.add_argument('-d', '--destination', required=True, help='Backup destination directory')
     parser.add_argument('-s', '--source', required=True, help='Backup source file/folder')
-    parser.add_argument('-i', '--include', nargs='+', help='Files to transfer')
-    parser.add_argument('-e', '--exclude', nargs='+', help='Files to ignore')
+    parser.add_argument('-i', '--include', nargs='+', help='Files to transfer (path prefixes or globs, ! negates)')
+    parser.add_argument('-e', '--exclude', nargs='+', help='Files to ignore (path prefixes or globs, ! negates)')
     parser.add_argument('-n', '--name', default=None, help='Destination base folder Name')
     parser.add_argument('-c', '--compress', action='store_true', default=False, help='Should compress source')
+    parser.add_argument('--codec', choices=available_codecs(), default='gz', help='Compression codec')
+    parser.add_argument('--level', type=int, default=None, help='Compression level')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of parallel copy or compression workers')
+    parser.add_argument('--seekable', action='store_true', default=False,
+                        help='Compress archives in indexed blocks so single files can be restored without reading it all')
+    parser.add_argument('--incremental', action='store_true', default=False,
+                        help='Only archive files changed since the previous archive, restores combine the chain')
+    parser.add_argument('--full-every', type=int, default=FULL_EVERY, help='Number of incremental archives between full ones')
+    parser.add_argument('-l', '--link', action='store_true', default=False, help='Hard link unchanged files to the previous version')
+    parser.add_argument('--dedup', action='store_true', default=False, help='Store versions as chunk manifests in a deduplicated store')
+    parser.add_argument('--prune-dirs', action='store_true', default=False,
+                        help='Skip listing directories whose mtime is unchanged when checking for changes')
     parser.add_argument('-f', '--force', action='store_true', default=False, help='Skip checking for changes')
+    parser.add_argument('-r', '--resume', action='store_true', default=False, help='Continue an interrupted backup from its last checkpoint')
+    parser.add_argument('--checkpoint-interval', type=int, default=CHECKPOINT_INTERVAL, help='Seconds between checkpoints')
+    parser.add_argument('--keep-last', type=int, default=None, help='Prune all but this many latest versions')
+    parser.add_argument('--keep-hourly', type=int, default=None, help='Also keep the last version of this many hours')
+    parser.add_argument('--keep-daily', type=int, default=None, help='Also keep the last version of this many days')
+    parser.add_argument('--keep-weekly', type=int, default=None, help='Also keep the last version of this many weeks')
+    parser.add_argument('--low-memory', action='store_true', default=False,
+                        help='Walk directories in sorted order with bounded memory, spilling huge listings to disk')
+    parser.add_argument('--journal', default=None,
+                        help='Check for changes in the directories changed since the last run only, as recorded by a journal.py watcher or found by directory mtimes')
+    parser.add_argument('--stats-json', default=None, help='Write file counts, bytes and phase times to this JSON file')
+    parser.add_argument('--profile', default=None, help='Write cProfile stats of the run to this file')
+    parser.add_argument('--trace-memory', action='store_true', default=False, help='Print the peak memory and largest allocations')
+    add_throttle_arguments(parser)
 
     if len(sys.argv) == 1:
         parser.print_help()
@@ -23,67 +61,178 @@ def parse_args():
     return parser.parse_args()
 
 
-def get_last_modified(directory, include, exclude):
-    list_of_files = get_file_tree(directory, '', include, exclude)
-    latest_file = max(list_of_files, key=lambda fn: os.path.getmtime(os.path.join(directory, fn)), default=0)
-    return os.stat(os.path.join(directory, latest_file)).st_mtime
-
-
 def is_newer(source_time, destination_time):
     return source_time - destination_time > 2
 
 
-def has_version_changed(source, destination, name=None, include=None, exclude=None):
+# Outputs of interrupted runs, newest first
+def get_partial_backups(destination, basename):
+    pattern = get_version_pattern(basename)
+    return sorted((item for item in os.listdir(destination)
+                   if pattern.match(item) and item.endswith(PARTIAL_EXTENSION)), reverse=True)
+
+
+def remove_partial_backup(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+    checkpoint = path[:-len(PARTIAL_EXTENSION)] + CHECKPOINT_EXTENSION
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+
+def get_directory_cache_path(destination, basename):
+    return os.path.join(destination, '.' + basename + DIRECTORY_CACHE_EXTENSION)
+
+
+def has_version_changed(source, destination, name=None, include=None, exclude=None, prune_dirs=False, cache=None, catalog=None, tracker=None):
     if not (os.path.exists(source) and os.path.isdir(source)):
         return False
     if not (os.path.exists(destination) and os.path.isdir(destination)):
         return True
 
+    # Read even without a previous version, the fallback caches directory mtimes
+    changes = tracker.read() if tracker is not None else None
     source_basename = name if name else os.path.basename(source)
-    list_of_backups = list(filter(lambda fn: os.path.basename(fn).startswith(source_basename), os.listdir(destination)))
-    if len(list_of_backups) == 0:
+    if catalog is None:
+        catalog = VersionCatalog(destination, source_basename)
+    latest_backup = catalog.get_latest()
+    if latest_backup is None:
         return True
-    latest_backup = max(list_of_backups, key=lambda file: os.path.getctime(os.path.join(destination, file)))
 
-    return is_newer(get_last_modified(source, include, exclude), os.path.getctime(os.path.join(destination, latest_backup)))
+    if changes is not None:
+        return not changes.is_empty()
+
+    # Same 2 second tolerance as is_newer, stops at the first newer file
+    since = latest_backup['time'] + 2
+    if cache is None and prune_dirs:
+        cache = DirectoryCache(get_directory_cache_path(destination, source_basename))
+    changed = find_newer(source, since, include, exclude, cache) is not None
+    if cache is not None:
+        cache.save()
+    return changed
 
 
-def transfer_file(source, destination):
+def transfer_file(source, destination, st=None):
+    if st is None:
+        st = os.stat(source)
     try:
-        if os.path.isdir(source):
+        if stat.S_ISDIR(st.st_mode):
             if not os.path.exists(destination):
                 os.mkdir(destination)
-                shutil.copystat(source, destination)
+                copy_stat(st, destination)
+        elif stat.S_ISLNK(st.st_mode):
+            copy_symlink(source, destination, st)
         else:
-            shutil.copy2(source, destination)
+            copy_file(source, destination, st)
     except FileNotFoundError:
-        os.makedirs(os.path.dirname(destination))
-        transfer_file(source, destination)
+        parent = os.path.dirname(destination)
+        if os.path.isdir(parent) or not os.path.lexists(source):
+            raise
+        os.makedirs(parent, exist_ok=True)
+        transfer_file(source, destination, st)
 
 
-def should_copy(file_name, include=None, exclude=None):
-    if include:
-        for include_item in include:
-            if file_name.startswith(include_item):
-                return True
+# Hard link the file from the previous version if it wasn't modified since.
+# Versions share the linked inode, so its permissions and owner have to match
+def link_unchanged(entry, previous, destination):
+    try:
+        st = os.stat(previous)
+    except FileNotFoundError:
+        return False
+    if st.st_size != entry.size or st.st_mtime_ns != entry.stat.st_mtime_ns or st.st_mode != entry.stat.st_mode or \
+            st.st_uid != entry.stat.st_uid or st.st_gid != entry.stat.st_gid:
+        return False
+    try:
+        os.link(previous, destination)
+    except OSError:
         return False
-
-    if exclude:
-        for exclude_item in exclude:
-            if file_name.startswith(exclude_item):
-                return False
-        return True
-
     return True
 
 
-def get_file_tree(directory, base, include=None, exclude=None):
-    for item in os.listdir(directory):
-        s = os.path.join(base, item)
-        if should_copy(s, include, exclude):
-            yield s
-            if os.path.isdir(os.path.join(directory, item)):
-                yield from get_file_tree(os.path.join(directory, item), s, include, exclude)
+def copy_entry(entry, destination, previous=None, checkpoint=None, stats=None):
+    copied = None
+    if not (previous and link_unchanged(entry, os.path.join(previous, entry.name), destination)):
+        try:
+            transfer_file(entry.path, destination, entry.stat)
+        except FileNotFoundError:
+            if os.path.lexists(entry.path):
+                raise
+            # Deleted since the scan, left out of the version
+            if stats is not None:
+                stats.add(files_vanished=1)
+            return None
+        copied = entry.size
+        if stats is not None:
+            stats.add(bytes_read=copied)
+    if checkpoint is not None:
+        checkpoint.commit(entry.name)
+    return copied
+
+
+def write_archive(entries, path, codec, level, jobs, resume=False, checkpoint_interval=CHECKPOINT_INTERVAL, seekable=False, stats=None):
+    partial = path + PARTIAL_EXTENSION
+    checkpoint_path = path + CHECKPOINT_EXTENSION
+    names, state = load_checkpoint(checkpoint_path) if resume else (set(), {})
+    offset = state.get('offset')
+    if offset is not None and (not os.path.exists(partial) or os.path.getsize(partial) < offset or
+                               seekable != ('blocks' in state)):
+        names, state, offset = set(), {}, None
+    checkpoint = Checkpoint(checkpoint_path, checkpoint_interval, offset is not None)
+    index = ArchiveIndex(codec, state.get('members', ()), state.get('blocks', ())) if seekable else None
+    # The partial archive is kept on errors, the next run resumes it
+    with open_archive(partial, codec, level, jobs, offset, state.get('position', 0), index, BLOCK_SIZE if seekable else None) as tar:
+        for entry in entries:
+            if entry.name in names:
+                continue
+            add_to_tar(tar, entry)
+            checkpoint.commit(entry.name)
+            if stats is not None and not entry.is_dir:
+                stats.add(files_copied=1, bytes_read=entry.size)
+            # Only between members, the archive holds everything committed so far
+            if checkpoint.is_due():
+                offset = tar.checkpoint()
+                checkpoint.save(offset=offset, position=tar.offset, **(index.get_changes() if index is not None else {}))
+    if index is not None:
+        index.save(get_index_path(path))
+    os.replace(partial, path)
+    checkpoint.remove()
+    if stats is not None:
+        stats.add(bytes_written=os.path.getsize(path))
+
+
+def copy_version(source, destination, include, exclude, jobs, previous=None, resume=False, checkpoint_interval=CHECKPOINT_INTERVAL, stats=None,
+                 low_memory=False):
+    partial = destination + PARTIAL_EXTENSION
+    checkpoint_path = destination + CHECKPOINT_EXTENSION
+    names, _ = load_checkpoint(checkpoint_path) if resume else (set(), {})
+    checkpoint = Checkpoint(checkpoint_path, checkpoint_interval, resume)
+    scheduler = CopyScheduler(jobs, stats=stats)
+    entries = get_scanner(low_memory)(source, '', include, exclude, True)
+    # No stat for the version root, the catalog records when the version was taken
+    scheduler.open_directory('', None, partial)
+    try:
+        for entry in prefetch(stats.scan(entries) if stats is not None else entries):
+            d = os.path.join(partial, entry.name)
+            if entry.is_dir:
+                if scheduler.is_open(entry.name):
+                    scheduler.close_directory(entry.name)
+                else:
+                    scheduler.open_directory(entry.name, entry.stat, d)
+            elif entry.name not in names:
+                scheduler.submit(entry.name, copy_entry, (entry, d, previous, checkpoint, stats))
+                if checkpoint.is_due():
+                    checkpoint.save()
+    except BaseException:
+        # Files are renamed into place once written, every committed one is complete
+        scheduler.cancel()
+        checkpoint.save()
+        raise
+    scheduler.wait()
+    scheduler.close_directory('')
+    os.replace(partial, destination)
+    checkpoint.remove()
 
 
 def print_progress(header, status, is_end=False):
@@ -95,51 +244,101 @@ def print_backup_state(file, status, is_end=False):
     print_progress('Backing up ' + '\'' + file + '\'', status, is_end)
 
 
-def backup(source, destination, name=None, include=None, exclude=None, compress=True, force=False):
+def backup(source, destination, name=None, include=None, exclude=None, compress=True, force=False, codec='gz', level=None, jobs=1, dedup=False, link=False, prune_dirs=False, cache=None,
+           resume=False, checkpoint_interval=CHECKPOINT_INTERVAL, seekable=False, keep_last=None, keep_hourly=None, keep_daily=None, keep_weekly=None,
+           stats=None, incremental=False, full_every=FULL_EVERY, low_memory=False, journal=None):
     print_backup_state(source, 'WORKING')
     if not os.path.exists(source):
         print_backup_state(source, 'NOT FOUND', True)
         return
+    if stats is None:
+        stats = BackupStats()
 
     if not os.path.exists(destination):
         os.makedirs(destination)
     
     backup_file = None
 
-    if force or has_version_changed(source, destination, name, include, exclude):
-        date = datetime.now().strftime('%Y_%m_%d_%H%M%S')
-        if name:
-            basename = name
-        else:
-            basename = os.path.basename(os.path.normpath(source))
-        destination = os.path.join(destination, basename + '_' + date)
-
-        file_list = get_file_tree(source, '', include, exclude)
-        if compress:
-            backup_file = destination + '.tgz'
-            tar = tarfile.open(backup_file, 'w')
-            for file_item in file_list:
-                tar.add(os.path.join(source, file_item), arcname=file_item, recursive=False)
-            tar.close()
+    if name:
+        basename = name
+    else:
+        basename = os.path.basename(os.path.normpath(source))
+    extension = get_extension(codec) if compress and not dedup else ''
+    partial = None
+    for item in get_partial_backups(destination, basename):
+        path = os.path.join(destination, item)
+        matches = item.endswith(extension + PARTIAL_EXTENSION) and os.path.isdir(path) == (not extension)
+        if resume and not dedup and partial is None and matches:
+            partial = path[:-len(PARTIAL_EXTENSION) - len(extension)]
         else:
-            backup_file = destination
-            for file_item in file_list:
-                s = os.path.join(source, file_item)
-                d = os.path.join(destination, file_item)
-                if os.path.isdir(s):
-                    os.makedirs(d)
-                else:
-                    transfer_file(s, d)
-                shutil.copystat(s, d)
+            remove_partial_backup(path)
+
+    catalog = VersionCatalog(destination, basename)
+    tracker = ChangeTracker(source, journal) if journal else None
+    with stats.timed('decide'):
+        changed = partial or force or has_version_changed(source, destination, name, include, exclude, prune_dirs, cache, catalog, tracker)
+    if changed:
+        # Files modified while the version is written must count as newer than it
+        started = time.time()
+        entries = prefetch(stats.scan(get_scanner(low_memory)(source, '', include, exclude)))
+        date = datetime.now().strftime('%Y_%m_%d_%H%M%S')
+        root = destination
+        base = None
+        destination = partial or os.path.join(destination, basename + '_' + date)
+
+        with report_progress(stats, lambda status: print_backup_state(source, status)):
+            if dedup:
+                backup_file = destination + MANIFEST_EXTENSION
+                previous = catalog.get_latest('manifest')
+                with stats.timed('copy'):
+                    store = write_snapshot(entries, root, backup_file, catalog.get_path(previous) if previous else None)
+                stats.add(files_copied=stats.counters['files_scanned'], bytes_read=store.bytes_read, bytes_written=store.bytes_written)
+                kind = 'manifest'
+            elif compress:
+                backup_file = destination + extension
+                snapshot = None
+                if incremental:
+                    previous = catalog.get_latest('archive')
+                    snapshot = start_snapshot(catalog.get_path(previous) if previous else None, full_every)
+                    entries = snapshot.select(entries)
+                with stats.timed('compress'):
+                    write_archive(entries, backup_file, codec, level, jobs, partial is not None, checkpoint_interval, seekable, stats)
+                if snapshot is not None:
+                    snapshot.save(backup_file)
+                    base = snapshot.base
+                    stats.add(files_skipped=stats.counters['files_scanned'] - len(snapshot.archived))
+                kind = 'archive'
+            else:
+                backup_file = destination
+                previous = catalog.get_latest('dir') if link else None
+                previous = catalog.get_path(previous) if previous else None
+                copy_version(source, destination, include, exclude, jobs, previous, partial is not None, checkpoint_interval, stats, low_memory)
+                kind = 'dir'
+        catalog.add(os.path.basename(backup_file), kind, started, base)
+        catalog.save()
         print_backup_state(source, 'DONE', True)
     else:
         print_backup_state(source, 'UP TO DATE', True)
+    if tracker is not None:
+        tracker.commit()
+
+    policy = RetentionPolicy(keep_last, keep_hourly, keep_daily, keep_weekly)
+    if policy.is_set():
+        prune(catalog.destination, basename, policy, catalog=catalog)
+    stats.stop()
     return backup_file
 
 
 def main():
     args = parse_args()
-    backup(args.source, args.destination, args.name, args.include, args.exclude, args.compress, args.force)
+    stats = BackupStats()
+    with profiled(args.profile, args.trace_memory), throttled(throttle_from_args(args)):
+        backup(args.source, args.destination, args.name, args.include, args.exclude, args.compress, args.force,
+               args.codec, args.level, args.jobs, args.dedup, args.link, args.prune_dirs, None, args.resume, args.checkpoint_interval,
+               args.seekable, args.keep_last, args.keep_hourly, args.keep_daily, args.keep_weekly, stats, args.incremental,
+               args.full_every, args.low_memory, args.journal)
+    if args.stats_json:
+        stats.save(args.stats_json)
 
 
 if __name__ == '__main__':
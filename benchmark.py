@@ -0,0 +1,420 @@
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import argparse
+import tempfile
+import contextlib
+import multiprocessing
+import backup
+import backup_version
+from file_tree import scan_tree, add_to_tar
+from compression import open_archive, available_codecs
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+TREES = ('small', 'huge', 'deep', 'sparse', 'flat')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark Backups')
+    parser.add_argument('-f', '--files', type=int, default=2000, help='Number of files to generate')
+    parser.add_argument('-w', '--width', type=int, default=20, help='Files per directory')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the generated tree')
+    parser.add_argument('--suite', choices=['syscalls', 'codecs', 'parallel', 'scenarios'], default='syscalls', help='Benchmark suite to run')
+    parser.add_argument('--corpus-size', type=int, default=32, help='Size of the codec corpus in MB')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Maximum number of workers to scale to')
+    parser.add_argument('--trees', nargs='+', choices=TREES, default=list(TREES), help='Synthetic trees of the scenarios suite')
+    parser.add_argument('--size', type=int, default=64, help='Size of the huge and sparse trees in MB')
+    parser.add_argument('--depth', type=int, default=64, help='Nesting depth of the deep tree')
+    parser.add_argument('--low-memory', action='store_true', default=False, help='Run the scenarios in the bounded-memory mode')
+    parser.add_argument('-o', '--output', default=None, help='Write the results to this JSON file instead of stdout')
+    parser.add_argument('--compare', default=None, help='Results of an earlier run to compare against')
+    return parser.parse_args()
+
+
+class SyscallCounter:
+    names = ('stat', 'lstat', 'fstat', 'listdir', 'scandir')
+
+    def __init__(self):
+        self.counts = dict.fromkeys(self.names + ('entry_stat',), 0)
+
+    def wrap(self, name, func):
+        def wrapper(*args, **kwargs):
+            self.counts[name] += 1
+            return func(*args, **kwargs)
+        return wrapper
+
+    def wrap_scandir(self, func):
+        counter = self
+
+        class EntryProxy:
+            def __init__(self, entry):
+                self._entry = entry
+                self._stat = {}
+
+            def __getattr__(self, item):
+                return getattr(self._entry, item)
+
+            def __fspath__(self):
+                return self._entry.path
+
+            def stat(self, *, follow_symlinks=True):
+                if follow_symlinks not in self._stat:
+                    counter.counts['entry_stat'] += 1
+                    self._stat[follow_symlinks] = self._entry.stat(follow_symlinks=follow_symlinks)
+                return self._stat[follow_symlinks]
+
+        class ScandirProxy:
+            def __init__(self, it):
+                self._it = it
+
+            def __iter__(self):
+                return (EntryProxy(entry) for entry in self._it)
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                self._it.close()
+
+            def close(self):
+                self._it.close()
+
+        def wrapper(*args, **kwargs):
+            self.counts['scandir'] += 1
+            return ScandirProxy(func(*args, **kwargs))
+        return wrapper
+
+    @property
+    def stat_calls(self):
+        return self.counts['stat'] + self.counts['lstat'] + self.counts['entry_stat']
+
+    @contextlib.contextmanager
+    def patch(self):
+        originals = {name: getattr(os, name) for name in self.names}
+        try:
+            for name in self.names:
+                if name == 'scandir':
+                    setattr(os, name, self.wrap_scandir(originals[name]))
+                else:
+                    setattr(os, name, self.wrap(name, originals[name]))
+            yield self
+        finally:
+            for name, func in originals.items():
+                setattr(os, name, func)
+
+
+# Many files of up to 4 KiB, `width` per directory
+def generate_tree(root, rng, files, width, size=None, depth=None):
+    os.makedirs(root)
+    directories = [root]
+    for i in range(files):
+        if i and i % width == 0:
+            directories.append(os.path.join(rng.choice(directories), f'dir{i // width}'))
+            os.mkdir(directories[-1])
+        with open(os.path.join(directories[-1], f'file{i}.txt'), 'wb') as f:
+            f.write(rng.randbytes(rng.randint(0, 4096)))
+    return files + len(directories) - 1
+
+
+# A handful of files sharing `size` MB
+def generate_huge(root, rng, files, width, size, depth):
+    os.makedirs(root)
+    count = 4
+    for i in range(count):
+        with open(os.path.join(root, f'huge{i}.bin'), 'wb') as f:
+            for _ in range(size // count):
+                f.write(rng.randbytes(1024 * 1024))
+
+
+# A chain of `depth` directories with a few files on every level
+def generate_deep(root, rng, files, width, size, depth):
+    directory = root
+    os.makedirs(directory)
+    for level in range(depth):
+        for i in range(max(1, files // depth)):
+            with open(os.path.join(directory, f'file{i}.txt'), 'wb') as f:
+                f.write(rng.randbytes(rng.randint(0, 4096)))
+        directory = os.path.join(directory, f'level{level}')
+        os.mkdir(directory)
+
+
+# Files of `size` MB in total with 64 KiB of data every MB and holes between
+def generate_sparse(root, rng, files, width, size, depth):
+    os.makedirs(root)
+    count = 4
+    for i in range(count):
+        with open(os.path.join(root, f'sparse{i}.img'), 'wb') as f:
+            for offset in range(0, size // count * 1024 * 1024, 1024 * 1024):
+                f.seek(offset)
+                f.write(rng.randbytes(64 * 1024))
+            f.truncate(size // count * 1024 * 1024)
+
+
+# All files empty in one directory, peak RSS of the bounded-memory mode
+# should not grow with `files`
+def generate_flat(root, rng, files, width, size, depth):
+    os.makedirs(root)
+    for i in range(files):
+        open(os.path.join(root, f'file{i}.txt'), 'wb').close()
+
+
+GENERATORS = {'small': generate_tree, 'huge': generate_huge, 'deep': generate_deep, 'sparse': generate_sparse,
+              'flat': generate_flat}
+
+
+def get_tree_size(root):
+    entries = list(scan_tree(root))
+    return len(entries), sum(entry.size for entry in entries if not entry.is_dir)
+
+
+# Rewrite every 20th file with new data and move its mtime past the two
+# second tolerance of the change checks
+def modify_tree(root, rng):
+    files = [entry for entry in scan_tree(root) if not entry.is_dir]
+    changed = 0
+    mtime = time.time() + 10
+    for entry in files[::20]:
+        with open(entry.path, 'r+b') as f:
+            f.write(rng.randbytes(min(entry.size, 4096)))
+        os.utime(entry.path, (mtime, mtime))
+        changed += entry.size
+    return changed
+
+
+def read_io_counters():
+    try:
+        with open('/proc/self/io', 'r') as f:
+            return {key: int(value) for key, value in (line.split(': ') for line in f)}
+    except OSError:
+        return {}
+
+
+@contextlib.contextmanager
+def quiet():
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def measure(name, entries, func):
+    counter = SyscallCounter()
+    start = time.perf_counter()
+    with quiet(), counter.patch():
+        func()
+    elapsed = time.perf_counter() - start
+    return {
+        'scenario': name,
+        'seconds': round(elapsed, 4),
+        'files_per_second': round(entries / elapsed, 1) if elapsed else None,
+        'stat_calls': counter.stat_calls,
+        'stat_calls_per_file': round(counter.stat_calls / entries, 2),
+        'syscalls': counter.counts,
+    }
+
+
+def _measure_backup(kind, source, destination, options):
+    run_backup = backup.backup if kind == 'mirror' else backup_version.backup
+    counter = SyscallCounter()
+    io = read_io_counters()
+    start = time.perf_counter()
+    with quiet(), counter.patch():
+        run_backup(source, destination, **options)
+    elapsed = time.perf_counter() - start
+    after = read_io_counters()
+    return {
+        'seconds': elapsed,
+        'stat_calls': counter.stat_calls,
+        # Kernel counts of read and write calls, including those of the copy threads
+        'read_calls': after['syscr'] - io['syscr'] if io else None,
+        'write_calls': after['syscw'] - io['syscw'] if io else None,
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1) if resource else None,
+    }
+
+
+# Every run gets its own process so its peak RSS is its own. Children forked
+# from this one would start from its high water mark, the fork server is small
+def measure_backup(tree, scenario, kind, source, destination, options, entries, size):
+    if kind == 'version':
+        # Versions are named by the second they were taken in
+        time.sleep(1 - time.time() % 1)
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    with multiprocessing.get_context(method).Pool(1) as pool:
+        result = pool.apply(_measure_backup, (kind, source, destination, options))
+    elapsed = result.pop('seconds')
+    return {
+        'tree': tree,
+        'scenario': scenario,
+        'seconds': round(elapsed, 4),
+        'files_per_second': round(entries / elapsed, 1) if elapsed else None,
+        'mb_per_second': round(size / 1048576 / elapsed, 2) if elapsed and size else None,
+        **result,
+    }
+
+
+# Full, incremental and unchanged runs of the mirror and version backups on
+# reproducible synthetic trees. Incremental runs follow a rewrite of every
+# 20th file, their MB/s counts the rewritten files only
+def run_scenarios(trees, files, width, size, depth, seed=0, low_memory=False):
+    results = []
+    for tree in trees:
+        work_dir = tempfile.mkdtemp(prefix='backup_bench_')
+        try:
+            source = os.path.join(work_dir, 'project')
+            GENERATORS[tree](source, random.Random(seed), files, width, size, depth)
+            entries, tree_size = get_tree_size(source)
+            rng = random.Random(seed + 1)
+            for kind, options in (('mirror', {'compress': False}), ('version', {'compress': False, 'link': True})):
+                options['low_memory'] = low_memory
+                destination = os.path.join(work_dir, kind)
+                results.append(measure_backup(tree, kind + ' full', kind, source, destination, options, entries, tree_size))
+                changed = modify_tree(source, rng)
+                results.append(measure_backup(tree, kind + ' incremental', kind, source, destination, options, entries, changed))
+                results.append(measure_backup(tree, kind + ' unchanged', kind, source, destination, options, entries, 0))
+        finally:
+            shutil.rmtree(work_dir)
+    return results
+
+
+# Seconds of the same benchmark in an earlier run and how much faster or
+# slower this one was
+def compare_results(results, baseline):
+    keys = ('tree', 'scenario', 'codec', 'level', 'jobs')
+    previous = {tuple(result.get(key) for key in keys): result for result in baseline}
+    for result in results:
+        old = previous.get(tuple(result.get(key) for key in keys))
+        if old and old.get('seconds') and result.get('seconds'):
+            result['baseline_seconds'] = old['seconds']
+            result['baseline_speedup'] = round(old['seconds'] / result['seconds'], 2)
+    return results
+
+
+def run(files, width, seed=0):
+    work_dir = tempfile.mkdtemp(prefix='backup_bench_')
+    try:
+        source = os.path.join(work_dir, 'project')
+        entries = generate_tree(source, random.Random(seed), files, width)
+        mirror = os.path.join(work_dir, 'mirror')
+        archive = os.path.join(work_dir, 'archive')
+        versions = os.path.join(work_dir, 'versions')
+        return [
+            measure('mirror full', entries, lambda: backup.backup(source, mirror)),
+            measure('mirror unchanged', entries, lambda: backup.backup(source, mirror)),
+            measure('mirror trees', entries, lambda: backup.backup(source, mirror, compare_trees=True)),
+            measure('archive full', entries, lambda: backup.backup(source, archive, compress=True)),
+            measure('archive unchanged', entries, lambda: backup.backup(source, archive, compress=True)),
+            measure('version copy', entries, lambda: backup_version.backup(source, versions, compress=False)),
+            measure('version unchanged', entries, lambda: backup_version.backup(source, versions, compress=False)),
+            measure('version unchanged prune', entries,
+                    lambda: backup_version.backup(source, versions, compress=False, prune_dirs=True)),
+            measure('version unchanged pruned', entries,
+                    lambda: backup_version.backup(source, versions, compress=False, prune_dirs=True)),
+            measure('version archive', entries, lambda: backup_version.backup(source, versions, compress=True, force=True)),
+        ]
+    finally:
+        shutil.rmtree(work_dir)
+
+
+# Mix of repetitive text, random bytes and zero runs, roughly what a source
+# tree with some binaries in it compresses like
+def generate_corpus(root, size, seed=0):
+    rng = random.Random(seed)
+    words = [rng.randbytes(rng.randint(2, 10)).hex() for _ in range(2000)]
+    os.makedirs(root)
+    written = 0
+    i = 0
+    while written < size:
+        kind = i % 4
+        length = min(size - written, rng.randint(64 * 1024, 1024 * 1024))
+        if kind == 3:
+            data = rng.randbytes(length)
+        elif kind == 2:
+            data = bytes(length)
+        else:
+            data = ' '.join(rng.choice(words) for _ in range(length // 8)).encode()[:length]
+        with open(os.path.join(root, f'file{i}.dat'), 'wb') as f:
+            f.write(data)
+        written += len(data)
+        i += 1
+    return written
+
+
+def measure_archive(entries, size, archive, codec, level=None, jobs=1):
+    start = time.perf_counter()
+    tar = open_archive(archive, codec, level, jobs)
+    for entry in entries:
+        add_to_tar(tar, entry)
+    tar.close()
+    elapsed = time.perf_counter() - start
+    result = {
+        'codec': codec,
+        'level': level if level is not None else 'default',
+        'jobs': jobs,
+        'seconds': round(elapsed, 4),
+        'mb_per_second': round(size / 1048576 / elapsed, 2),
+        'ratio': round(size / os.path.getsize(archive), 3),
+    }
+    os.remove(archive)
+    return result
+
+
+def run_codecs(corpus_size, seed=0):
+    work_dir = tempfile.mkdtemp(prefix='backup_bench_')
+    try:
+        source = os.path.join(work_dir, 'corpus')
+        size = generate_corpus(source, corpus_size * 1024 * 1024, seed)
+        entries = list(scan_tree(source))
+        return [measure_archive(entries, size, os.path.join(work_dir, 'archive'), codec, level)
+                for codec in available_codecs() for level in (1, None, 9)]
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def run_parallel(corpus_size, max_jobs, seed=0):
+    work_dir = tempfile.mkdtemp(prefix='backup_bench_')
+    try:
+        source = os.path.join(work_dir, 'corpus')
+        size = generate_corpus(source, corpus_size * 1024 * 1024, seed)
+        entries = list(scan_tree(source))
+        jobs = sorted({1, max_jobs} | {2 ** i for i in range(1, max_jobs.bit_length()) if 2 ** i < max_jobs})
+        results = []
+        for codec in available_codecs():
+            baseline = None
+            for n in jobs:
+                result = measure_archive(entries, size, os.path.join(work_dir, 'archive'), codec, None, n)
+                baseline = baseline or result['seconds']
+                result['speedup'] = round(baseline / result['seconds'], 2)
+                results.append(result)
+        return results
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def main():
+    args = parse_args()
+    if args.suite == 'codecs':
+        results = run_codecs(args.corpus_size, args.seed)
+    elif args.suite == 'parallel':
+        results = run_parallel(args.corpus_size, args.jobs, args.seed)
+    elif args.suite == 'scenarios':
+        results = run_scenarios(args.trees, args.files, args.width, args.size, args.depth, args.seed, args.low_memory)
+    else:
+        results = run(args.files, args.width, args.seed)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            results = compare_results(results, json.load(f))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
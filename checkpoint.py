@@ -0,0 +1,87 @@
+import os
+import re
+import json
+import time
+import threading
+
+PARTIAL_EXTENSION = '.partial'
+CHECKPOINT_EXTENSION = '.checkpoint'
+CHECKPOINT_INTERVAL = 30
+STAGING_PATTERN = re.compile(r'\..+\.\d+' + re.escape(PARTIAL_EXTENSION), re.DOTALL)
+
+
+def is_partial(name):
+    return name.endswith((PARTIAL_EXTENSION, CHECKPOINT_EXTENSION, '.tmp'))
+
+
+# Files are copied to a hidden name next to their destination and renamed
+# into place. The name carries the process id, a source file named like the
+# destination plus an extension can't be overwritten by it
+def get_staging_path(path):
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f'.{name}.{os.getpid()}{PARTIAL_EXTENSION}')
+
+
+def is_staging(name):
+    return STAGING_PATTERN.fullmatch(os.path.basename(name)) is not None
+
+
+# Append-only log of the files a backup has committed, saved every `interval`
+# seconds so an interrupted run can be resumed. Each line holds the names
+# committed since the previous line and the state needed to continue the
+# output from there, e.g. the archive offset
+class Checkpoint:
+    def __init__(self, path, interval=CHECKPOINT_INTERVAL, resume=False):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pending = []
+        self.last = time.monotonic()
+        if not resume:
+            self.remove()
+
+    def commit(self, name):
+        with self.lock:
+            self.pending.append(name)
+
+    def is_due(self):
+        return time.monotonic() - self.last >= self.interval
+
+    def save(self, **state):
+        with self.lock:
+            names, self.pending = self.pending, []
+        with open(self.path, 'a') as f:
+            f.write(json.dumps({'names': names, **state}, separators=(',', ':')) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.last = time.monotonic()
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+# Names committed so far and the state saved up to the last complete line
+def load_checkpoint(path):
+    names = set()
+    state = {}
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Cut off while being written
+                    break
+                names.update(record.pop('names'))
+                # Lists are logged in parts like the names, the rest is replaced
+                for key, value in record.items():
+                    if isinstance(value, list):
+                        state.setdefault(key, []).extend(value)
+                    else:
+                        state[key] = value
+    except FileNotFoundError:
+        pass
+    return names, state
@@ -0,0 +1,126 @@
+import os
+import sys
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from compression import open_archive_reader
+from file_index import FileIndex, INDEX_NAME
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+READ_SIZE = 1024 * 1024
+HASH_NAME = 'xxh3' if xxhash is not None else 'blake2b'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Verify Backup')
+    parser.add_argument('-d', '--destination', required=True, help='Backup destination directory or archive to verify')
+    parser.add_argument('-s', '--source', default=None, help='Source folder to compare an archive against')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='Number of parallel hashing workers')
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit()
+
+    return parser.parse_args()
+
+
+def new_hasher():
+    if xxhash is not None:
+        return xxhash.xxh3_128()
+    return hashlib.blake2b(digest_size=16)
+
+
+# Digests carry the algorithm name, a hash taken with another one never matches
+def get_digest(hasher):
+    return HASH_NAME + ':' + hasher.hexdigest()
+
+
+def hash_stream(f):
+    hasher = new_hasher()
+    while True:
+        data = f.read(READ_SIZE)
+        if not data:
+            break
+        hasher.update(data)
+    return get_digest(hasher)
+
+
+def hash_file(path):
+    with open(path, 'rb') as f:
+        return hash_stream(f)
+
+
+def _check_file(path, expected):
+    if not expected.startswith(HASH_NAME + ':'):
+        return 'UNKNOWN HASH'
+    try:
+        return None if hash_file(path) == expected else 'CORRUPT'
+    except FileNotFoundError:
+        return 'MISSING'
+
+
+# Re-hash every file of a mirror against the hashes its index recorded when
+# the files were copied with --checksum
+def verify_destination(destination, jobs=4):
+    if not os.path.exists(os.path.join(destination, INDEX_NAME)):
+        raise ValueError(f'\'{destination}\' has no index, back it up with --checksum first')
+    with FileIndex(destination) as index:
+        records = sorted((name, record.hash) for name, record in index.records.items() if record.hash)
+    with ThreadPoolExecutor(max_workers=max(1, jobs), thread_name_prefix='verify') as executor:
+        problems = executor.map(lambda record: _check_file(os.path.join(destination, record[0]), record[1]), records)
+        return [(name, problem) for (name, _), problem in zip(records, problems) if problem]
+
+
+def _hash_source(path):
+    try:
+        return hash_file(path)
+    except FileNotFoundError:
+        return None
+
+
+# Read an archive through once, which checks its compression and tar
+# structure, and compare its files to the source hashed in parallel
+def verify_archive(path, source=None, jobs=4):
+    pending = []
+    with ThreadPoolExecutor(max_workers=max(1, jobs), thread_name_prefix='verify') as executor:
+        with open_archive_reader(path) as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                digest = hash_stream(tar.extractfile(member))
+                if source is not None:
+                    future = executor.submit(_hash_source, os.path.join(source, *member.name.split('/')))
+                    pending.append((member.name, digest, future))
+        problems = []
+        for name, digest, future in pending:
+            expected = future.result()
+            if expected is None:
+                problems.append((name, 'MISSING'))
+            elif expected != digest:
+                problems.append((name, 'DIFFERENT'))
+        return problems
+
+
+def main():
+    args = parse_args()
+    try:
+        if os.path.isdir(args.destination):
+            problems = verify_destination(args.destination, args.jobs)
+        else:
+            problems = verify_archive(args.destination, args.source, args.jobs)
+    except Exception as e:
+        print(f'Could not verify \'{args.destination}\': {e}')
+        sys.exit(1)
+    for name, problem in problems:
+        print(f'{problem}: {name}')
+    print(f'Verified \'{args.destination}\': {len(problems)} problems')
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
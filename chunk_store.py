@@ -0,0 +1,290 @@
+import os
+import sys
+import json
+import random
+import hashlib
+import functools
+import argparse
+import stat
+from concurrent.futures import ThreadPoolExecutor
+from file_tree import copy_stat, get_matcher, get_restore_path
+from throttle import get_throttle, ThrottledReader
+
+CHUNKS_NAME = '.chunks'
+MANIFEST_EXTENSION = '.manifest'
+READ_SIZE = 1024 * 1024
+MIN_CHUNK_SIZE = 32 * 1024
+MAX_CHUNK_SIZE = 256 * 1024
+# 15 bits gives an average of 32 KiB past the minimum size, the high bits of
+# a gear hash are the ones that depend on the whole 32 byte window
+CHUNK_MASK = 0xfffe0000
+WINDOW_SIZE = 32
+# Bytes hashed at once while looking for a cut, most cuts are found in the
+# first window past the minimum size
+SCAN_SIZE = 16 * 1024
+# Bytes per hash in the lanes of the big integer they are computed in, the
+# bits above the 32 of a hash hold carries and flags
+LANE_SIZE = 5
+
+# Fixed seed, changing the table changes every chunk boundary
+_gear_random = random.Random(0x67656172)
+GEAR = [_gear_random.getrandbits(32) for _ in range(256)]
+# bytes.translate tables giving each byte of the gear value of a byte
+GEAR_BYTES = [bytes((gear >> 8 * i) & 0xff for gear in GEAR) for i in range(4)]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Restore Snapshot')
+    parser.add_argument('-s', '--source', required=True, help='Snapshot manifest to restore')
+    parser.add_argument('-d', '--destination', required=True, help='Restore destination directory')
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit()
+
+    return parser.parse_args()
+
+
+def _repeat_lane(value, count):
+    return int.from_bytes(value.to_bytes(LANE_SIZE, 'little') * count, 'little')
+
+
+@functools.lru_cache(maxsize=8)
+def _get_lane_masks(count):
+    steps = []
+    width = 1
+    while width < WINDOW_SIZE:
+        # Bits that would be shifted past the 32 bits of a hash are dropped
+        # first, so lanes never carry into each other
+        steps.append(((LANE_SIZE * 8 + 1) * width, _repeat_lane((1 << (32 - width)) - 1, count)))
+        width *= 2
+    return steps, _repeat_lane(CHUNK_MASK, count), _repeat_lane(0xffffffff, count)
+
+
+# The gear hash of every position in [start, end) at once. The hash at a
+# position is the sum of the gear values of the 32 bytes ending there, each
+# shifted by its distance, mod 2**32. With one gear value per lane of a big
+# integer, shifting the integer by a lane and a bit adds a byte to every
+# window, the 32 shifted copies are summed in 5 doublings. Returns the first
+# position whose masked hash is zero, or -1
+def _find_boundary(data, start, end):
+    window = data[start - WINDOW_SIZE + 1:end]
+    count = len(window)
+    lanes = bytearray(LANE_SIZE * count)
+    for i, table in enumerate(GEAR_BYTES):
+        lanes[i::LANE_SIZE] = window.translate(table)
+    hashes = int.from_bytes(lanes, 'little')
+    steps, chunk_mask, carry = _get_lane_masks(count)
+    for shift, low in steps:
+        hashes += (hashes & low) << shift
+    # Masked hashes that aren't zero carry into the 33rd bit of their lane
+    flags = ((hashes & chunk_mask) + carry).to_bytes(LANE_SIZE * count, 'little')[4::LANE_SIZE]
+    i = flags.find(0, WINDOW_SIZE - 1, count)
+    return -1 if i < 0 else start + i - WINDOW_SIZE + 1
+
+
+# Length of the chunk starting at `start`. The hash only depends on the
+# window, so positions before the minimum size are never hashed
+def find_cut(data, start=0):
+    size = len(data) - start
+    if size <= MIN_CHUNK_SIZE:
+        return size
+    end = min(size, MAX_CHUNK_SIZE)
+    for offset in range(MIN_CHUNK_SIZE, end, SCAN_SIZE):
+        position = _find_boundary(data, start + offset, start + min(offset + SCAN_SIZE, end))
+        if position >= 0:
+            return position - start + 1
+    return end
+
+
+# Content-defined chunking with a gear rolling hash, boundaries depend on the
+# bytes around them so an insertion only changes the chunks it touches. Reads
+# go into one buffer that chunks are cut from, the cut ones are dropped
+# before it grows
+def iter_chunks(f):
+    buffer = bytearray()
+    start = 0
+    eof = False
+    while not eof or start < len(buffer):
+        if not eof and len(buffer) - start < MAX_CHUNK_SIZE:
+            data = f.read(READ_SIZE)
+            eof = not data
+            del buffer[:start]
+            start = 0
+            buffer += data
+            continue
+        cut = find_cut(buffer, start)
+        yield bytes(buffer[start:start + cut])
+        start += cut
+
+
+class ChunkStore:
+    def __init__(self, destination):
+        self.root = os.path.join(destination, CHUNKS_NAME)
+        self.known = None
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def load_known(self):
+        self.known = set()
+        os.makedirs(self.root, exist_ok=True)
+        for directory in os.scandir(self.root):
+            if directory.is_dir():
+                self.known.update(item.name for item in os.scandir(directory.path) if not item.name.endswith('.tmp'))
+
+    def path(self, chunk_hash):
+        return os.path.join(self.root, chunk_hash[:2], chunk_hash)
+
+    def put(self, data):
+        chunk_hash = hashlib.sha256(data).hexdigest()
+        self.bytes_read += len(data)
+        if self.known is None:
+            self.load_known()
+        if chunk_hash not in self.known:
+            path = self.path(chunk_hash)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(path + '.tmp', path)
+            self.known.add(chunk_hash)
+            self.bytes_written += len(data)
+        return chunk_hash
+
+    def get(self, chunk_hash):
+        with open(self.path(chunk_hash), 'rb') as f:
+            return f.read()
+
+
+def load_manifest(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+# Remove the chunks no manifest in the destination refers to anymore. Run
+# after manifests were removed and while no backup writes to the destination
+def collect_garbage(destination):
+    referenced = set()
+    for item in os.listdir(destination):
+        if item.endswith(MANIFEST_EXTENSION):
+            for record in load_manifest(os.path.join(destination, item))['entries']:
+                referenced.update(record.get('chunks', ()))
+    root = os.path.join(destination, CHUNKS_NAME)
+    removed = 0
+    if not os.path.isdir(root):
+        return removed
+    for directory in os.scandir(root):
+        if directory.is_dir():
+            for item in os.scandir(directory.path):
+                if item.name not in referenced:
+                    os.remove(item.path)
+                    removed += 1
+    return removed
+
+
+def get_entry_record(entry, store, previous):
+    st = entry.stat
+    record = {'name': entry.name.replace(os.sep, '/'), 'mode': st.st_mode, 'mtime_ns': st.st_mtime_ns}
+    if entry.is_dir:
+        record['type'] = 'dir'
+    elif entry.is_symlink:
+        record['type'] = 'symlink'
+        record['target'] = os.readlink(entry.path)
+    else:
+        record['type'] = 'file'
+        record['size'] = st.st_size
+        old = previous.get(record['name'])
+        # Unchanged files reuse the previous chunk list without being read
+        if old and old['type'] == 'file' and old['size'] == st.st_size and old['mtime_ns'] == st.st_mtime_ns:
+            record['chunks'] = old['chunks']
+        else:
+            throttle = get_throttle()
+            with open(entry.path, 'rb') as f:
+                if throttle is not None:
+                    throttle.consume(files=1)
+                    f = ThrottledReader(f, throttle)
+                record['chunks'] = [store.put(chunk) for chunk in iter_chunks(f)]
+    return record
+
+
+def write_snapshot(entries, destination, manifest_path, previous_path=None):
+    store = ChunkStore(destination)
+    previous = {}
+    if previous_path:
+        previous = {record['name']: record for record in load_manifest(previous_path)['entries']}
+    manifest = {'format': 1, 'entries': [get_entry_record(entry, store, previous) for entry in entries]}
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, separators=(',', ':'))
+    os.replace(manifest_path + '.tmp', manifest_path)
+    return store
+
+
+def is_restored(path, record):
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return False
+    return stat.S_ISREG(st.st_mode) and st.st_size == record['size'] and st.st_mtime_ns == record['mtime_ns']
+
+
+def restore_file(store, record, path):
+    with open(path, 'wb') as f:
+        for chunk_hash in record['chunks']:
+            f.write(store.get(chunk_hash))
+    copy_stat(_RecordStat(record), path)
+
+
+# Files are written on `jobs` threads, unless forced the ones that already
+# match the record's size and mtime are left alone
+def restore_snapshot(manifest_path, target, include=None, exclude=None, jobs=1, force=True):
+    store = ChunkStore(os.path.dirname(os.path.abspath(manifest_path)))
+    matcher = get_matcher(include, exclude)
+    directories = []
+    restored = 0
+    os.makedirs(target, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=max(1, jobs), thread_name_prefix='restore') as executor:
+        futures = []
+        for record in load_manifest(manifest_path)['entries']:
+            if not matcher.selects(record['name'], record['type'] == 'dir'):
+                continue
+            try:
+                d = get_restore_path(target, record['name'], record['target'] if record['type'] == 'symlink' else None)
+            except ValueError as e:
+                print(f'Skipping \'{record["name"]}\': {e}')
+                continue
+            if record['type'] == 'dir':
+                os.makedirs(d, exist_ok=True)
+                directories.append((record, d))
+                continue
+            os.makedirs(os.path.dirname(d), exist_ok=True)
+            if record['type'] == 'symlink':
+                if os.path.lexists(d):
+                    os.remove(d)
+                os.symlink(record['target'], d)
+                restored += 1
+            elif force or not is_restored(d, record):
+                futures.append(executor.submit(restore_file, store, record, d))
+                restored += 1
+        for future in futures:
+            future.result()
+    # Directories last so writing their children doesn't touch their mtime
+    for record, d in reversed(directories):
+        copy_stat(_RecordStat(record), d)
+    return restored
+
+
+class _RecordStat:
+    __slots__ = ('st_mode', 'st_atime_ns', 'st_mtime_ns')
+
+    def __init__(self, record):
+        self.st_mode = record['mode']
+        self.st_atime_ns = record['mtime_ns']
+        self.st_mtime_ns = record['mtime_ns']
+
+
+def main():
+    args = parse_args()
+    restore_snapshot(args.source, args.destination)
+
+
+if __name__ == '__main__':
+    main()
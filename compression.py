@@ -0,0 +1,358 @@
+import os
+import bz2
+import gzip
+import lzma
+import time
+import zlib
+import struct
+import tarfile
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+BLOCK_SIZE = 1024 * 1024
+DICTIONARY_SIZE = 32 * 1024
+
+
+class Codec:
+    __slots__ = ('name', 'extension', 'default_level', 'levels', 'open', 'open_parallel', 'read')
+
+    def __init__(self, name, extension, default_level, levels, open, open_parallel=None, read=None):
+        self.name = name
+        self.extension = extension
+        self.default_level = default_level
+        self.levels = levels
+        self.open = open
+        self.open_parallel = open_parallel
+        self.read = read
+
+    @property
+    def available(self):
+        return self.name != 'zstd' or zstandard is not None
+
+
+def _deflate_block(data, level, dictionary, last):
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL,
+                                      zlib.Z_DEFAULT_STRATEGY, dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def _bz2_block(data, level, dictionary, last):
+    return bz2.compress(data, level)
+
+
+def _xz_block(data, level, dictionary, last):
+    return lzma.compress(data, preset=level)
+
+
+# Workers are started from a fork server where available, forking the
+# backup would copy its threads' locks in whatever state they are in
+def get_pool_context():
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return multiprocessing.get_context(method)
+
+
+# Splits the written stream into blocks and compresses them on a process pool,
+# blocks are written out in order. Used as is for codecs whose streams can be
+# concatenated (bz2, xz), every block becomes its own stream. end_stream()
+# finishes the current stream, later writes start a new one
+class ParallelWriter:
+    needs_last_block = False
+    uses_dictionary = False
+
+    def __init__(self, fileobj, compress_block, level, jobs, block_size=BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.compress_block = compress_block
+        self.level = level
+        self.jobs = jobs
+        self.block_size = block_size
+        self.executor = ProcessPoolExecutor(max_workers=jobs, mp_context=get_pool_context())
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.dictionary = b''
+        self.blocks = 0
+        self.started = False
+        self.closed = False
+
+    def header(self):
+        return b''
+
+    def trailer(self):
+        return b''
+
+    def update(self, data):
+        pass
+
+    def reset(self):
+        pass
+
+    def write(self, data):
+        if not self.started:
+            self.started = True
+            self.fileobj.write(self.header())
+        self.update(data)
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            block = bytes(self.buffer[:self.block_size])
+            del self.buffer[:self.block_size]
+            self._submit(block, False)
+        return len(data)
+
+    def _submit(self, block, last):
+        self.pending.append(self.executor.submit(self.compress_block, block, self.level, self.dictionary, last))
+        if self.uses_dictionary:
+            self.dictionary = block[-DICTIONARY_SIZE:]
+        self.blocks += 1
+        while len(self.pending) > self.jobs * 2:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def end_stream(self):
+        if not self.started:
+            self.fileobj.write(self.header())
+        if self.buffer or self.needs_last_block or not self.blocks:
+            self._submit(bytes(self.buffer), True)
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.fileobj.write(self.trailer())
+        self.buffer = bytearray()
+        self.dictionary = b''
+        self.blocks = 0
+        self.started = False
+        self.reset()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.end_stream()
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+
+
+# A single standard gzip member, like pigz: blocks are raw deflate streams
+# ended with a sync flush and primed with the tail of the previous block, the
+# CRC is computed over the whole input here
+class ParallelGzipWriter(ParallelWriter):
+    needs_last_block = True
+    uses_dictionary = True
+
+    def __init__(self, fileobj, level, jobs, block_size=BLOCK_SIZE):
+        self.crc = 0
+        self.size = 0
+        super().__init__(fileobj, _deflate_block, level, jobs, block_size)
+
+    def header(self):
+        extra_flags = 2 if self.level == 9 else 4 if self.level == 1 else 0
+        return b'\x1f\x8b\x08\x00' + struct.pack('<I', int(time.time())) + bytes((extra_flags, 255))
+
+    def trailer(self):
+        return struct.pack('<II', self.crc, self.size & 0xffffffff)
+
+    def update(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+
+    def reset(self):
+        self.crc = 0
+        self.size = 0
+
+
+def _open_zstd(fileobj, level, jobs=1):
+    return zstandard.ZstdCompressor(level=level, threads=jobs if jobs > 1 else 0).stream_writer(fileobj)
+
+
+def _read_zstd(fileobj):
+    # Checkpointed and seekable archives hold several frames
+    return zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True)
+
+
+CODECS = {
+    'gz': Codec('gz', '.tgz', 6, range(1, 10),
+                lambda fileobj, level: gzip.GzipFile(filename='', mode='wb', compresslevel=level, fileobj=fileobj),
+                lambda fileobj, level, jobs: ParallelGzipWriter(fileobj, level, jobs),
+                lambda fileobj: gzip.GzipFile(fileobj=fileobj, mode='rb')),
+    'bz2': Codec('bz2', '.tbz2', 9, range(1, 10),
+                 lambda fileobj, level: bz2.BZ2File(fileobj, 'wb', compresslevel=level),
+                 lambda fileobj, level, jobs: ParallelWriter(fileobj, _bz2_block, level, jobs),
+                 lambda fileobj: bz2.BZ2File(fileobj, 'rb')),
+    'xz': Codec('xz', '.txz', 6, range(0, 10),
+                lambda fileobj, level: lzma.LZMAFile(fileobj, 'wb', preset=level),
+                lambda fileobj, level, jobs: ParallelWriter(fileobj, _xz_block, level, jobs),
+                lambda fileobj: lzma.LZMAFile(fileobj, 'rb')),
+    'zstd': Codec('zstd', '.tzst', 3, range(1, 23), _open_zstd, _open_zstd, _read_zstd),
+}
+
+ARCHIVE_EXTENSIONS = {codec.extension for codec in CODECS.values()}
+
+
+def available_codecs():
+    return [name for name, codec in CODECS.items() if codec.available]
+
+
+def get_codec(name):
+    codec = CODECS.get(name)
+    if codec is None or not codec.available:
+        raise ValueError(f'Compression codec \'{name}\' is not available')
+    return codec
+
+
+def get_level(codec, level=None):
+    if level is None:
+        return codec.default_level
+    if level not in codec.levels:
+        raise ValueError(f'Invalid level {level} for codec \'{codec.name}\'')
+    return level
+
+
+def get_extension(name):
+    return CODECS[name].extension
+
+
+# Uncompressed side of an archive, written through the codec. A checkpoint
+# ends the current compressed stream so the file can later be cut at the
+# returned offset and appended to, every codec reads concatenated streams
+# back as one. With an index, a new stream is also started every
+# `block_size` bytes and each one is recorded so it can be read on its own
+class ArchiveStream:
+    def __init__(self, fileobj, codec, level, jobs=1, position=0, index=None, block_size=None):
+        self.fileobj = fileobj
+        self.codec = codec
+        self.level = level
+        self.jobs = jobs
+        self.position = position
+        self.index = index
+        self.block_size = block_size
+        self.block_position = position
+        if index is not None and not index.blocks:
+            index.add_block(fileobj.tell(), position)
+        self.compressed = self._open()
+
+    def _open(self):
+        if self.jobs > 1:
+            return self.codec.open_parallel(self.fileobj, self.level, self.jobs)
+        return self.codec.open(self.fileobj, self.level)
+
+    def write(self, data):
+        self.compressed.write(data)
+        self.position += len(data)
+        if self.block_size and self.position - self.block_position >= self.block_size:
+            self.end_block()
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def end_block(self):
+        reopen = False
+        if isinstance(self.compressed, ParallelWriter):
+            self.compressed.end_stream()
+        elif self.codec.name == 'zstd':
+            self.compressed.flush(zstandard.FLUSH_FRAME)
+        else:
+            self.compressed.close()
+            reopen = True
+        offset = self.fileobj.tell()
+        # Reopened after taking the offset, gzip writes its header right away
+        if reopen:
+            self.compressed = self._open()
+        self.block_position = self.position
+        if self.index is not None:
+            self.index.add_block(offset, self.position)
+        return offset
+
+    def checkpoint(self):
+        offset = self.end_block()
+        self.fileobj.flush()
+        os.fsync(self.fileobj.fileno())
+        return offset
+
+    def close(self):
+        self.compressed.close()
+
+
+class StreamingTarFile(tarfile.TarFile):
+    streams = ()
+    index = None
+
+    def addfile(self, tarinfo, fileobj=None):
+        super().addfile(tarinfo, fileobj)
+        if self.index is not None:
+            self.index.add(tarinfo, self.offset)
+
+    def checkpoint(self):
+        return self.fileobj.checkpoint()
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            for stream in self.streams:
+                stream.close()
+
+    # Unlike TarFile, the streams and compression workers are also released
+    # when the archive is abandoned. Errors doing so would hide the original
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+# Open a tar archive that is written as a stream through the codec, nothing
+# is ever seeked so memory stays flat regardless of the archive size. With an
+# offset and position from a checkpoint, an existing archive is cut at the
+# offset and appended to. An index records the members and where every
+# `block_size` block starts, see archive_index
+def open_archive(path, codec='gz', level=None, jobs=1, offset=None, position=0, index=None, block_size=None):
+    codec = get_codec(codec)
+    if offset is None:
+        fileobj = open(path, 'wb')
+    else:
+        fileobj = open(path, 'r+b')
+        fileobj.truncate(offset)
+        fileobj.seek(offset)
+    try:
+        stream = ArchiveStream(fileobj, codec, get_level(codec, level), jobs, position, index, block_size)
+        tar = StreamingTarFile.open(fileobj=stream, mode='w')
+    except BaseException:
+        fileobj.close()
+        raise
+    tar.streams = (stream, fileobj)
+    tar.index = index
+    return tar
+
+
+def get_path_codec(path):
+    for codec in CODECS.values():
+        if path.endswith(codec.extension):
+            return codec
+    return None
+
+
+# Open an archive for reading in a single sequential pass
+def open_archive_reader(path):
+    codec = get_path_codec(path)
+    if codec is None or not codec.available:
+        return tarfile.open(path, 'r|*')
+    fileobj = open(path, 'rb')
+    try:
+        stream = codec.read(fileobj)
+        tar = StreamingTarFile.open(fileobj=stream, mode='r|')
+    except BaseException:
+        fileobj.close()
+        raise
+    tar.streams = (stream, fileobj)
+    return tar
@@ -0,0 +1,464 @@
+import os
+import sys
+import time
+import errno
+import queue
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from file_tree import copy_stat, diff_trees
+from checkpoint import get_staging_path
+from throttle import get_throttle
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+DELTA_BLOCK_SIZE = 1024 * 1024
+DELTA_MIN_SIZE = 8 * 1024 * 1024
+COPY_BUFSIZE = 1024 * 1024
+KERNEL_COPY_SIZE = 1024 * 1024 * 1024
+FICLONE = 0x40049409
+# Errors meaning a copy method doesn't work between these files, the next
+# method is tried instead
+FALLBACK_ERRORS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.ENOTTY, errno.EOPNOTSUPP, errno.EBADF}
+
+
+class PendingDirectory:
+    __slots__ = ('st', 'destination', 'parent', 'pending', 'closed')
+
+    def __init__(self, st, destination, parent):
+        self.st = st
+        self.destination = destination
+        self.parent = parent
+        self.pending = 0
+        self.closed = False
+
+
+class WorkerStats:
+    __slots__ = ('files', 'bytes', 'seconds')
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    @property
+    def throughput(self):
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+
+class DeltaStats:
+    __slots__ = ('min_size', 'files', 'size', 'written', 'lock')
+
+    def __init__(self, min_size=DELTA_MIN_SIZE):
+        self.min_size = min_size
+        self.files = 0
+        self.size = 0
+        self.written = 0
+        self.lock = threading.Lock()
+
+    def add(self, size, written):
+        with self.lock:
+            self.files += 1
+            self.size += size
+            self.written += written
+
+    def print_stats(self):
+        print(f'Delta transfer: {self.files} files, wrote {self.written / 1048576:.1f} MB '
+              f'of {self.size / 1048576:.1f} MB')
+
+
+def _copy_file_range(src, dst, offset, count):
+    return os.copy_file_range(src, dst, count, offset, offset)
+
+
+def _sendfile(src, dst, offset, count):
+    os.lseek(dst, offset, os.SEEK_SET)
+    return os.sendfile(dst, src, offset, count)
+
+
+KERNEL_COPIES = []
+if hasattr(os, 'copy_file_range'):
+    KERNEL_COPIES.append(_copy_file_range)
+if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+    KERNEL_COPIES.append(_sendfile)
+
+# (method, source device, destination device) that failed with one of
+# FALLBACK_ERRORS, support depends on both filesystems
+_unsupported = set()
+
+
+def _clone(src, dst, devices):
+    if fcntl is None or (_clone,) + devices in _unsupported:
+        return False
+    try:
+        fcntl.ioctl(dst, FICLONE, src)
+    except OSError as e:
+        if e.errno not in FALLBACK_ERRORS:
+            raise
+        _unsupported.add((_clone,) + devices)
+        return False
+    return True
+
+
+# Throttled copies go in buffer sized steps so the limit can act between them
+def _kernel_copy(copy, src, dst, offset, end, throttle=None):
+    size = KERNEL_COPY_SIZE if throttle is None else COPY_BUFSIZE
+    while offset < end:
+        start = time.perf_counter()
+        copied = copy(src, dst, offset, min(end - offset, size))
+        if not copied:
+            break
+        if throttle is not None:
+            throttle.after_io(copied, time.perf_counter() - start)
+        offset += copied
+    return offset
+
+
+def _user_copy(fsrc, fdst, offset, end, hasher=None, throttle=None):
+    fsrc.seek(offset)
+    fdst.seek(offset)
+    while offset < end:
+        start = time.perf_counter()
+        data = fsrc.read(min(end - offset, COPY_BUFSIZE))
+        if not data:
+            break
+        if throttle is not None:
+            throttle.after_io(len(data), time.perf_counter() - start)
+        fdst.write(data)
+        if hasher is not None:
+            hasher.update(data)
+        offset += len(data)
+    return offset
+
+
+_zeros = memoryview(bytes(COPY_BUFSIZE))
+
+
+def _hash_zeros(hasher, size):
+    while size > 0:
+        hasher.update(_zeros[:min(size, COPY_BUFSIZE)])
+        size -= COPY_BUFSIZE
+
+
+def is_sparse(st):
+    return hasattr(os, 'SEEK_DATA') and getattr(st, 'st_blocks', st.st_size) * 512 < st.st_size
+
+
+# Ranges of the file that hold data, holes in between read as zeros
+def get_data_ranges(fd, size):
+    ranges = []
+    offset = 0
+    try:
+        while offset < size:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+            offset = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+            if start < offset:
+                ranges.append((start, offset))
+    except OSError as e:
+        # ENXIO: only a hole is left past offset
+        if e.errno == errno.EINVAL:
+            return [(0, size)]
+        if e.errno != errno.ENXIO:
+            raise
+    return ranges
+
+
+# Copy the file contents without passing them through userspace when
+# possible: a reflink (FICLONE) shares the extents outright, otherwise the
+# data ranges go through copy_file_range or sendfile. Holes in sparse files
+# are skipped so they stay holes on the destination. Methods that aren't
+# supported for a filesystem are remembered and not tried again. With a
+# hasher the data has to pass through userspace, it is hashed as it is
+# copied and holes are hashed as the zeros they read as. Data passes through
+# the active throttle, reflinks don't read any
+def copy_data(fsrc, fdst, st, hasher=None):
+    src = fsrc.fileno()
+    dst = fdst.fileno()
+    devices = (st.st_dev, os.fstat(dst).st_dev)
+    if hasher is None and _clone(src, dst, devices):
+        return
+    throttle = get_throttle()
+    sparse = is_sparse(st)
+    position = 0
+    for start, end in get_data_ranges(src, st.st_size) if sparse else [(0, st.st_size)]:
+        if hasher is not None:
+            _hash_zeros(hasher, start - position)
+            position = _user_copy(fsrc, fdst, start, end, hasher, throttle)
+            continue
+        for copy in KERNEL_COPIES:
+            if (copy,) + devices in _unsupported:
+                continue
+            try:
+                start = _kernel_copy(copy, src, dst, start, end, throttle)
+                break
+            except OSError as e:
+                if e.errno not in FALLBACK_ERRORS:
+                    raise
+                _unsupported.add((copy,) + devices)
+        else:
+            start = _user_copy(fsrc, fdst, start, end, throttle=throttle)
+    if sparse:
+        if hasher is not None:
+            _hash_zeros(hasher, st.st_size - position)
+        fdst.truncate(st.st_size)
+
+
+# Written under a temporary name and renamed into place, an interrupted copy
+# never leaves a truncated file that looks up to date
+def copy_file(source, destination, st, hasher=None):
+    partial = get_staging_path(destination)
+    throttle = get_throttle()
+    if throttle is not None:
+        throttle.consume(files=1)
+    try:
+        with open(source, 'rb') as fsrc, open(partial, 'wb') as fdst:
+            copy_data(fsrc, fdst, st, hasher)
+        copy_stat(st, partial)
+        os.replace(partial, destination)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+
+
+# Dangling symlinks are copied as links, the scan follows every other one
+# and its target is copied as a file
+def copy_symlink(source, destination, st):
+    partial = get_staging_path(destination)
+    if os.path.lexists(partial):
+        os.remove(partial)
+    os.symlink(os.readlink(source), partial)
+    if os.utime in os.supports_follow_symlinks:
+        os.utime(partial, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+    os.replace(partial, destination)
+
+
+# Update an existing destination file in place, writing only the blocks that
+# differ from the source. Both files are local so blocks are compared
+# directly at the same offsets instead of through rolling checksums
+def delta_copy(source, destination, st, block_size=DELTA_BLOCK_SIZE, hasher=None):
+    written = 0
+    offset = 0
+    throttle = get_throttle()
+    if throttle is not None:
+        throttle.consume(files=1)
+    with open(source, 'rb') as fsrc, open(destination, 'r+b') as fdst:
+        while True:
+            start = time.perf_counter()
+            block = fsrc.read(block_size)
+            if not block:
+                break
+            if throttle is not None:
+                throttle.after_io(len(block), time.perf_counter() - start)
+            if hasher is not None:
+                hasher.update(block)
+            if fdst.read(len(block)) != block:
+                fdst.seek(offset)
+                fdst.write(block)
+                written += len(block)
+            offset += len(block)
+        fdst.truncate(offset)
+    copy_stat(st, destination)
+    return written
+
+
+def remove_path(path, is_dir):
+    if is_dir:
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+# Delete everything in the destination that is no longer in the source on a
+# thread pool, names starting with one of `keep` are left in place
+def prune_tree(source, destination, include=None, exclude=None, jobs=1, keep=()):
+    removed = []
+    with ThreadPoolExecutor(max_workers=max(1, jobs), thread_name_prefix='delete') as executor:
+        futures = []
+        for name, is_dir in diff_trees(source, destination, include, exclude):
+            if name.startswith(keep):
+                continue
+            futures.append(executor.submit(remove_path, os.path.join(destination, name), is_dir))
+            removed.append((name, is_dir))
+        for future in futures:
+            future.result()
+    return removed
+
+
+# Runs a bounded producer in a background thread so the consumer overlaps
+# with it, e.g. scanning the next directories while files are copied
+def prefetch(iterable, size=1024):
+    items = queue.Queue(size)
+    done = object()
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                while not stop.is_set():
+                    try:
+                        items.put((item, None), timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            items.put((done, None))
+        except BaseException as e:
+            items.put((done, e))
+
+    thread = threading.Thread(target=produce, name='scan', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+# Copy pipeline: files are first checked for changes on a pool of check
+# workers, changed ones are handed to the copy workers. Both stages are
+# bounded so a slow stage holds back the ones in front of it. Directories
+# are created before any of their children are scheduled and their stat is
+# copied only once every child (file or directory) has finished. Checks,
+# copies and stat copies are counted and timed in `stats` if given
+class CopyScheduler:
+    def __init__(self, jobs=1, queue_size=None, check_jobs=None, stats=None):
+        self.jobs = max(1, jobs)
+        self.check_jobs = check_jobs or self.jobs * 4
+        self.executor = ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix='copy')
+        self.check_executor = ThreadPoolExecutor(max_workers=self.check_jobs, thread_name_prefix='check')
+        self.slots = threading.BoundedSemaphore(queue_size or self.jobs * 4)
+        self.check_slots = threading.BoundedSemaphore(self.check_jobs * 4)
+        self.lock = threading.Lock()
+        self.directories = {}
+        self.worker_stats = {}
+        self.stats = stats
+        self.errors = []
+
+    def open_directory(self, name, st, destination):
+        os.makedirs(destination, exist_ok=True)
+        parent = self.directories.get(os.path.dirname(name)) if name else None
+        with self.lock:
+            if parent:
+                parent.pending += 1
+            self.directories[name] = PendingDirectory(st, destination, parent)
+
+    def close_directory(self, name):
+        directory = self.directories.pop(name)
+        with self.lock:
+            directory.closed = True
+            ready = directory.pending == 0
+        if ready:
+            self._finalize(directory)
+
+    def is_open(self, name):
+        return name in self.directories
+
+    # Queue func(*args) as a child of the directory `name` lives in, func
+    # returns the number of bytes it copied. With a check, func only runs if
+    # check(*check_args) returns true
+    def submit(self, name, func, args, check=None, check_args=()):
+        parent = self.directories.get(os.path.dirname(name))
+        if parent:
+            with self.lock:
+                parent.pending += 1
+        if check is None:
+            self._queue(parent, func, args)
+        else:
+            self.check_slots.acquire()
+            self.check_executor.submit(self._check, parent, func, args, check, check_args)
+
+    def wait(self):
+        self.check_executor.shutdown(wait=True)
+        self.executor.shutdown(wait=True)
+        if self.errors:
+            raise self.errors[0]
+
+    # For callers that are already failing: queued work is dropped, running
+    # checks and copies are waited for and their errors are not raised
+    def cancel(self):
+        self.check_executor.shutdown(wait=True, cancel_futures=True)
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def _queue(self, parent, func, args):
+        self.slots.acquire()
+        self.executor.submit(self._run, parent, func, args)
+
+    def _check(self, parent, func, args, check, check_args):
+        try:
+            start = time.perf_counter()
+            changed = check(*check_args)
+            if self.stats is not None:
+                self.stats.add_time('decide', time.perf_counter() - start)
+            if changed:
+                self._queue(parent, func, args)
+            else:
+                if self.stats is not None:
+                    self.stats.add(files_skipped=1)
+                if parent:
+                    self._child_done(parent)
+        except Exception as e:
+            self.errors.append(e)
+        finally:
+            self.check_slots.release()
+
+    def _run(self, parent, func, args):
+        try:
+            start = time.perf_counter()
+            copied = func(*args)
+            elapsed = time.perf_counter() - start
+            stats = self._get_worker_stats()
+            if copied is not None:
+                stats.files += 1
+                stats.bytes += copied
+            stats.seconds += elapsed
+            if self.stats is not None:
+                self.stats.add_time('copy', elapsed)
+                # Nothing copied, e.g. hard linked to the previous version
+                if copied is None:
+                    self.stats.add(files_skipped=1)
+                else:
+                    self.stats.add(files_copied=1, bytes_written=copied)
+            if parent:
+                self._child_done(parent)
+        except Exception as e:
+            self.errors.append(e)
+        finally:
+            self.slots.release()
+
+    def _get_worker_stats(self):
+        name = threading.current_thread().name
+        if name not in self.worker_stats:
+            with self.lock:
+                self.worker_stats.setdefault(name, WorkerStats())
+        return self.worker_stats[name]
+
+    def _child_done(self, directory):
+        with self.lock:
+            directory.pending -= 1
+            ready = directory.closed and directory.pending == 0
+        if ready:
+            self._finalize(directory)
+
+    def _finalize(self, directory):
+        if directory.st is not None:
+            start = time.perf_counter()
+            copy_stat(directory.st, directory.destination)
+            if self.stats is not None:
+                self.stats.add_time('copystat', time.perf_counter() - start)
+        if directory.parent:
+            self._child_done(directory.parent)
+
+    def print_stats(self):
+        for name, stats in sorted(self.worker_stats.items()):
+            print(f'{name}: {stats.files} files, {stats.bytes / 1048576:.1f} MB, '
+                  f'{stats.throughput / 1048576:.1f} MB/s')
@@ -0,0 +1,83 @@
+import os
+import sqlite3
+import threading
+
+INDEX_NAME = '.backup_index.sqlite'
+
+
+class FileRecord:
+    __slots__ = ('size', 'mtime_ns', 'inode', 'hash')
+
+    def __init__(self, size, mtime_ns, inode, hash=None):
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.inode = inode
+        self.hash = hash
+
+    def matches(self, st):
+        return self.size == st.st_size and self.mtime_ns == st.st_mtime_ns and self.inode == st.st_ino
+
+
+# Persistent record of every file written to a destination, lets change
+# detection compare the source against the index instead of statting the
+# destination. Updates are buffered and written in one transaction on flush
+# or close. An index may be kept open and used by several backups in turn
+class FileIndex:
+    def __init__(self, destination):
+        self.path = os.path.join(destination, INDEX_NAME)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS files ('
+                                'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, hash TEXT)')
+        self.records = {path: FileRecord(size, mtime_ns, inode, hash) for path, size, mtime_ns, inode, hash
+                        in self.connection.execute('SELECT path, size, mtime_ns, inode, hash FROM files')}
+        self.lock = threading.Lock()
+        self.updated = {}
+        self.removed = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __contains__(self, name):
+        return name in self.records
+
+    def get(self, name):
+        return self.records.get(name)
+
+    def has_changed(self, entry):
+        record = self.records.get(entry.name)
+        return record is None or not record.matches(entry.stat)
+
+    def update(self, entry, hash=None):
+        st = entry.stat
+        record = FileRecord(st.st_size, st.st_mtime_ns, st.st_ino, hash)
+        with self.lock:
+            self.records[entry.name] = record
+            self.updated[entry.name] = record
+            self.removed.discard(entry.name)
+
+    def remove(self, name, is_dir=True):
+        with self.lock:
+            if is_dir:
+                paths = [path for path in self.records if path == name or path.startswith(name + os.sep)]
+            else:
+                paths = [name] if name in self.records else []
+            for path in paths:
+                del self.records[path]
+                self.updated.pop(path, None)
+                self.removed.add(path)
+
+    def flush(self):
+        with self.lock:
+            removed, self.removed = self.removed, set()
+            updated, self.updated = self.updated, {}
+        with self.connection:
+            self.connection.executemany('DELETE FROM files WHERE path = ?', ((path,) for path in removed))
+            self.connection.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                                        ((path, r.size, r.mtime_ns, r.inode, r.hash) for path, r in updated.items()))
+
+    def close(self):
+        self.flush()
+        self.connection.close()
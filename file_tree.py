@@ -0,0 +1,539 @@
+import os
+import re
+import json
+import stat
+import heapq
+import tempfile
+import functools
+import tarfile
+from throttle import get_throttle, ThrottledReader
+
+try:
+    import pwd
+except ImportError:
+    pwd = None
+
+try:
+    import grp
+except ImportError:
+    grp = None
+
+# Directory listings longer than this are sorted in runs spilled to
+# temporary files and merged, instead of being held in memory
+SPILL_THRESHOLD = 100000
+RUN_READ_SIZE = 16 * 1024
+
+
+class FileEntry:
+    __slots__ = ('name', 'path', 'stat', 'is_symlink')
+
+    def __init__(self, name, path, st, is_symlink=False):
+        self.name = name
+        self.path = path
+        self.stat = st
+        self.is_symlink = is_symlink
+
+    @property
+    def is_dir(self):
+        return stat.S_ISDIR(self.stat.st_mode)
+
+    @property
+    def size(self):
+        return self.stat.st_size
+
+    @property
+    def mtime(self):
+        return self.stat.st_mtime
+
+    @property
+    def mode(self):
+        return self.stat.st_mode
+
+    def __repr__(self):
+        return f'FileEntry({self.name!r})'
+
+
+# '[...]' is only a character class in patterns that are globs anyway, so
+# names like 'a[1].txt' keep matching literally
+GLOB_CHARACTERS = '*?'
+WILDCARD_CHARACTERS = '*?['
+
+
+def translate_glob(pattern):
+    parts = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '*':
+            if pattern.startswith('**/', i):
+                # Zero or more directories
+                parts.append('(?:.*/)?')
+                i += 3
+                continue
+            if pattern.startswith('**', i):
+                parts.append('.*')
+                i += 2
+                continue
+            parts.append('[^/]*')
+        elif c == '?':
+            parts.append('[^/]')
+        elif c == '[' and ']' in pattern[i + 2:]:
+            end = pattern.index(']', i + 2)
+            body = pattern[i + 1:end]
+            if body.startswith('!'):
+                body = '^' + body[1:]
+            parts.append('[' + body.replace('\\', '\\\\') + ']')
+            i = end
+        else:
+            parts.append(re.escape(c))
+        i += 1
+    return ''.join(parts)
+
+
+def compile_patterns(patterns):
+    alternatives = []
+    prefixes = []
+    # Reversed so the first alternative that matches is the last pattern,
+    # later patterns override earlier ones
+    for i, pattern in reversed(list(enumerate(patterns))):
+        negated = pattern.startswith('!')
+        pattern = pattern[1:] if negated else pattern
+        pattern = pattern.replace(os.sep, '/')
+        glob = any(c in pattern for c in GLOB_CHARACTERS)
+        if glob:
+            regex = translate_glob(pattern) + '(?:/.*)?'
+        else:
+            # Plain patterns keep matching as path prefixes
+            regex = re.escape(pattern) + '.*'
+        alternatives.append(f'(?P<{"n" if negated else "p"}{i}>{regex})')
+        if not negated:
+            literal = []
+            wildcard = False
+            for segment in pattern.split('/'):
+                if glob and any(c in segment for c in WILDCARD_CHARACTERS):
+                    wildcard = True
+                    break
+                literal.append(segment)
+            else:
+                # Plain patterns match by prefix, the last segment is matched
+                # directly and doesn't have to be descended into
+                literal.pop()
+            prefixes.append((literal, wildcard))
+    return re.compile('|'.join(alternatives), re.DOTALL), prefixes
+
+
+# Include and exclude patterns compiled into one regex each. Patterns without
+# glob characters match as path prefixes, '*' and '?' stay inside a path
+# segment, '**' spans directories and a leading '!' negates a pattern
+class PathMatcher:
+    def __init__(self, include=None, exclude=None):
+        self.include = None
+        self.exclude = None
+        self.trie = None
+        if include:
+            self.include, prefixes = compile_patterns(include)
+            # Literal leading directories of the include patterns, a directory
+            # outside all of them can't contain anything that is included
+            self.trie = {}
+            for prefix, wildcard in prefixes:
+                node = self.trie
+                for segment in prefix:
+                    node = node.setdefault(segment, {})
+                if wildcard:
+                    node[''] = True
+        if exclude:
+            self.exclude, _ = compile_patterns(exclude)
+
+    @staticmethod
+    def _matches(regex, name):
+        match = regex.fullmatch(name)
+        return match is not None and match.lastgroup[0] == 'p'
+
+    def matches(self, name):
+        if os.sep != '/':
+            name = name.replace(os.sep, '/')
+        if self.include is not None and not self._matches(self.include, name):
+            return False
+        return self.exclude is None or not self._matches(self.exclude, name)
+
+    def should_descend(self, name):
+        if self.include is None:
+            return False
+        if os.sep != '/':
+            name = name.replace(os.sep, '/')
+        if self.exclude is not None and self._matches(self.exclude, name):
+            return False
+        node = self.trie
+        for segment in name.split('/'):
+            if '' in node:
+                return True
+            node = node.get(segment)
+            if node is None:
+                return False
+        return True
+
+    # Whether the walker should visit the entry, directories that aren't
+    # matched themselves are still visited if they can contain matches
+    def selects(self, name, is_dir=False):
+        return self.matches(name) or (is_dir and self.should_descend(name))
+
+
+@functools.lru_cache(maxsize=32)
+def _get_matcher(include, exclude):
+    return PathMatcher(include, exclude)
+
+
+def get_matcher(include=None, exclude=None):
+    return _get_matcher(tuple(include) if include else None, tuple(exclude) if exclude else None)
+
+
+def should_copy(file_name, include=None, exclude=None):
+    return get_matcher(include, exclude).matches(file_name)
+
+
+# Entries directly in a directory that the matcher selects, with the stat
+# result of the scan
+def scan_directory(directory, base='', matcher=None):
+    if matcher is None:
+        matcher = get_matcher()
+    try:
+        with os.scandir(directory) as it:
+            items = list(it)
+    except FileNotFoundError:
+        return
+    for item in items:
+        s = os.path.join(base, item.name)
+        if matcher.selects(s, item.is_dir()):
+            try:
+                st = item.stat()
+            except FileNotFoundError:
+                if not item.is_symlink():
+                    continue
+                # Dangling symlink, keep the link itself
+                st = item.stat(follow_symlinks=False)
+            yield FileEntry(s, item.path, st, item.is_symlink())
+
+
+# A directory followed by the entries found in it. Directories the matcher
+# only entered to look for matches are yielded once something in them was
+def walk_directory(entry, children, matcher, update_dirs=False):
+    if matcher.matches(entry.name):
+        yield entry
+        yield from children
+    else:
+        found = False
+        for child in children:
+            if not found:
+                yield entry
+                found = True
+            yield child
+        if not found:
+            return
+    if update_dirs:
+        yield entry
+
+
+# Walk a directory yielding entries that carry the stat result of the scan,
+# so consumers never have to stat source files again
+def scan_tree(directory, base='', include=None, exclude=None, update_dirs=False):
+    matcher = get_matcher(include, exclude)
+    for entry in scan_directory(directory, base, matcher):
+        if entry.is_dir:
+            yield from walk_directory(entry, scan_tree(entry.path, entry.name, include, exclude, update_dirs),
+                                      matcher, update_dirs)
+        else:
+            yield entry
+
+
+class DirectoryItem:
+    __slots__ = ('name', 'is_dir')
+
+    def __init__(self, name, is_dir):
+        self.name = name
+        self.is_dir = is_dir
+
+    def __lt__(self, other):
+        return self.name < other.name
+
+
+# Records are a type byte and the encoded name ended by a NUL, which no file
+# name can contain
+def _write_run(items):
+    f = tempfile.TemporaryFile()
+    f.write(b''.join((b'd' if item.is_dir else b'f') + os.fsencode(item.name) + b'\0' for item in items))
+    f.seek(0)
+    return f
+
+
+def _read_run(f):
+    rest = b''
+    while True:
+        data = f.read(RUN_READ_SIZE)
+        if not data:
+            return
+        records = (rest + data).split(b'\0')
+        rest = records.pop()
+        for record in records:
+            yield DirectoryItem(os.fsdecode(record[1:]), record[:1] == b'd')
+
+
+# The items of a directory sorted by name. Memory is bounded by
+# `spill_threshold` items however large the directory is, longer listings
+# are sorted in runs of that size on disk and merged while being read
+def iter_sorted_directory(directory, follow_symlinks=True, spill_threshold=SPILL_THRESHOLD):
+    items = []
+    runs = []
+    try:
+        try:
+            with os.scandir(directory) as it:
+                for item in it:
+                    try:
+                        is_dir = item.is_dir(follow_symlinks=follow_symlinks)
+                    except OSError:
+                        is_dir = False
+                    items.append(DirectoryItem(item.name, is_dir))
+                    if len(items) >= spill_threshold:
+                        items.sort()
+                        runs.append(_write_run(items))
+                        items = []
+        except FileNotFoundError:
+            return
+        items.sort()
+        if not runs:
+            yield from items
+            return
+        runs.append(_write_run(items))
+        items = None
+        yield from heapq.merge(*(_read_run(f) for f in runs))
+    finally:
+        for f in runs:
+            f.close()
+
+
+def _stat_item(path):
+    st = os.lstat(path)
+    if not stat.S_ISLNK(st.st_mode):
+        return st, False
+    try:
+        return os.stat(path), True
+    except FileNotFoundError:
+        # Dangling symlink, keep the link itself
+        return st, True
+
+
+# Bounded-memory scan_tree: directories are listed with
+# iter_sorted_directory and visited in name order, only the directories
+# being descended hold a position in their listing
+def scan_tree_sorted(directory, base='', include=None, exclude=None, update_dirs=False, spill_threshold=SPILL_THRESHOLD):
+    matcher = get_matcher(include, exclude)
+    for item in iter_sorted_directory(directory, spill_threshold=spill_threshold):
+        s = os.path.join(base, item.name)
+        if matcher.selects(s, item.is_dir):
+            path = os.path.join(directory, item.name)
+            try:
+                st, is_symlink = _stat_item(path)
+            except FileNotFoundError:
+                continue
+            entry = FileEntry(s, path, st, is_symlink)
+            if entry.is_dir:
+                yield from walk_directory(entry, scan_tree_sorted(path, s, include, exclude, update_dirs, spill_threshold),
+                                          matcher, update_dirs)
+            else:
+                yield entry
+
+
+def get_scanner(low_memory=False):
+    return scan_tree_sorted if low_memory else scan_tree
+
+
+DIRECTORY_CACHE_EXTENSION = '.dircache'
+
+
+# Remembers the subdirectories of every directory together with the
+# directory's mtime, while the mtime is unchanged nothing was added, removed
+# or renamed in it and its listing can be skipped
+class DirectoryCache:
+    def __init__(self, path):
+        self.path = path
+        self.directories = {}
+        try:
+            with open(path, 'r') as f:
+                self.directories = json.load(f)
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def get(self, name, mtime_ns):
+        cached = self.directories.get(name)
+        if cached and cached[0] == mtime_ns:
+            return cached[1]
+        return None
+
+    def set(self, name, mtime_ns, subdirectories):
+        self.directories[name] = [mtime_ns, subdirectories]
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.directories, f, separators=(',', ':'))
+        os.replace(self.path + '.tmp', self.path)
+
+
+# Look for any entry modified after `since`, stopping at the first one. With a
+# cache, directories whose mtime is unchanged are not listed again, only
+# their subdirectories are checked, so files edited in place are missed there
+def find_newer(directory, since, include=None, exclude=None, cache=None, base='', mtime_ns=None):
+    if cache is not None and mtime_ns is None:
+        mtime_ns = os.stat(directory).st_mtime_ns
+    subdirectories = cache.get(base, mtime_ns) if cache is not None else None
+    matcher = get_matcher(include, exclude)
+    pending = []
+    if subdirectories is None:
+        subdirectories = []
+        with os.scandir(directory) as it:
+            for item in it:
+                s = os.path.join(base, item.name)
+                is_dir = item.is_dir()
+                if is_dir:
+                    subdirectories.append(item.name)
+                if not matcher.selects(s, is_dir):
+                    continue
+                try:
+                    st = item.stat()
+                except FileNotFoundError:
+                    continue
+                if st.st_mtime > since:
+                    return s
+                if is_dir:
+                    pending.append((item.name, st))
+        if cache is not None:
+            cache.set(base, mtime_ns, subdirectories)
+    else:
+        for name in subdirectories:
+            s = os.path.join(base, name)
+            if not matcher.selects(s, True):
+                continue
+            try:
+                st = os.stat(os.path.join(directory, name))
+            except FileNotFoundError:
+                continue
+            if st.st_mtime > since:
+                return s
+            pending.append((name, st))
+    for name, st in pending:
+        newer = find_newer(os.path.join(directory, name), since, include, exclude, cache,
+                           os.path.join(base, name), st.st_mtime_ns)
+        if newer:
+            return newer
+    return None
+
+
+# Merge the sorted listings of both trees and yield the top-most destination
+# entries that are missing from the source, were replaced by a different
+# type or aren't selected anymore. Removed directories are not descended.
+# Listings are streamed, huge directories are spilled to disk
+def diff_trees(source, destination, include=None, exclude=None, base=''):
+    matcher = get_matcher(include, exclude)
+    source_items = iter_sorted_directory(os.path.join(source, base))
+    current = next(source_items, None)
+    for item in iter_sorted_directory(os.path.join(destination, base), False):
+        while current is not None and current.name < item.name:
+            current = next(source_items, None)
+        s = os.path.join(base, item.name)
+        if current is None or current.name != item.name or current.is_dir != item.is_dir or not matcher.selects(s, item.is_dir):
+            yield s, item.is_dir
+        elif item.is_dir:
+            yield from diff_trees(source, destination, include, exclude, s)
+
+
+def _is_within(path, root):
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+
+# Where the member `name` of a backup is restored to in `target`. Like
+# tarfile's 'data' filter, members with absolute names, leading out of
+# `target` through '..' or a symlink restored before them and symlinks
+# pointing out of it are rejected with a ValueError
+def get_restore_path(target, name, symlink=None):
+    root = os.path.realpath(target)
+    if name.startswith('/') or os.path.isabs(name):
+        raise ValueError(f'\'{name}\' is an absolute path')
+    path = os.path.normpath(os.path.join(root, *name.split('/')))
+    # A symlink member replaces what is there, anything else is written through it
+    resolved = os.path.realpath(os.path.dirname(path) if symlink is not None else path)
+    if not _is_within(path, root) or not _is_within(resolved, root):
+        raise ValueError(f'\'{name}\' is outside the destination')
+    if symlink is not None:
+        if os.path.isabs(symlink) or not _is_within(os.path.realpath(os.path.join(os.path.dirname(path), symlink)), root):
+            raise ValueError(f'\'{name}\' links outside the destination')
+    return path
+
+
+def get_file_tree(directory, base, include=None, exclude=None, update_dirs=False):
+    for entry in scan_tree(directory, base, include, exclude, update_dirs):
+        yield entry.name
+
+
+def get_last_modified(entries):
+    return max((entry.mtime for entry in entries), default=0)
+
+
+def copy_stat(st, destination):
+    os.utime(destination, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.chmod(destination, stat.S_IMODE(st.st_mode))
+
+
+_user_names = {}
+_group_names = {}
+
+
+def _user_name(uid):
+    if uid not in _user_names:
+        try:
+            _user_names[uid] = pwd.getpwuid(uid)[0] if pwd else ''
+        except KeyError:
+            _user_names[uid] = ''
+    return _user_names[uid]
+
+
+def _group_name(gid):
+    if gid not in _group_names:
+        try:
+            _group_names[gid] = grp.getgrgid(gid)[0] if grp else ''
+        except KeyError:
+            _group_names[gid] = ''
+    return _group_names[gid]
+
+
+def get_tar_info(entry):
+    st = entry.stat
+    info = tarfile.TarInfo(entry.name.replace(os.sep, '/'))
+    info.mode = st.st_mode
+    info.uid = st.st_uid
+    info.gid = st.st_gid
+    info.mtime = st.st_mtime
+    info.uname = _user_name(st.st_uid)
+    info.gname = _group_name(st.st_gid)
+    if entry.is_dir:
+        info.type = tarfile.DIRTYPE
+        info.size = 0
+    else:
+        info.type = tarfile.REGTYPE
+        info.size = st.st_size
+    return info
+
+
+def add_to_tar(tar, entry):
+    # Symlinks, hard links and special files are rare, let tarfile handle them
+    if entry.is_symlink or not (entry.is_dir or stat.S_ISREG(entry.mode)) or \
+            (not entry.is_dir and entry.stat.st_nlink > 1):
+        tar.add(entry.path, arcname=entry.name, recursive=False)
+        return
+    info = get_tar_info(entry)
+    if entry.is_dir:
+        tar.addfile(info)
+    else:
+        throttle = get_throttle()
+        with open(entry.path, 'rb') as f:
+            if throttle is not None:
+                throttle.consume(files=1)
+                f = ThrottledReader(f, throttle)
+            tar.addfile(info, f)
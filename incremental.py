@@ -0,0 +1,98 @@
+import os
+import json
+import stat
+
+SNAPSHOT_EXTENSION = '.snapshot'
+FULL_EVERY = 7
+
+
+def get_snapshot_path(archive):
+    return archive + SNAPSHOT_EXTENSION
+
+
+def load_snapshot(archive):
+    try:
+        with open(get_snapshot_path(archive), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_snapshot(archive, snapshot):
+    path = get_snapshot_path(archive)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(snapshot, f, separators=(',', ':'))
+    os.replace(path + '.tmp', path)
+
+
+def get_file_state(entry):
+    return [entry.stat.st_mode, entry.size, entry.stat.st_mtime_ns]
+
+
+# State of the tree an archive was written from, like a GNU tar snapshot
+# file. 'files' holds every selected entry, 'archived' the ones this archive
+# holds and 'deleted' those gone since the archive it is based on. A level 0
+# archive is full, a level N one only holds what changed since level N-1
+class Snapshot:
+    def __init__(self, base=None, previous=None):
+        self.base = base
+        self.level = previous['level'] + 1 if previous else 0
+        self.previous = previous['files'] if previous else {}
+        self.files = {}
+        self.archived = []
+
+    # Pass on the entries to archive: directories, so every archive has the
+    # whole structure, and files that are new or changed since the base
+    def select(self, entries):
+        for entry in entries:
+            name = entry.name.replace(os.sep, '/')
+            state = get_file_state(entry)
+            self.files[name] = state
+            if entry.is_dir:
+                yield entry
+            elif self.previous.get(name) != state:
+                self.archived.append(name)
+                yield entry
+
+    def save(self, archive):
+        save_snapshot(archive, {
+            'format': 1, 'level': self.level, 'base': self.base, 'files': self.files, 'archived': self.archived,
+            'deleted': sorted(name for name in self.previous if name not in self.files),
+        })
+
+
+# Start a new chain with a full archive once `full_every` increments were
+# written on top of the last one, or when the chain can't be continued
+def start_snapshot(previous_archive, full_every=FULL_EVERY):
+    previous = load_snapshot(previous_archive) if previous_archive else None
+    if previous is None or previous['level'] >= full_every:
+        return Snapshot()
+    return Snapshot(os.path.basename(previous_archive), previous)
+
+
+# (archive, snapshot) pairs from the given archive back to its full archive
+def load_chain(archive):
+    chain = []
+    while True:
+        snapshot = load_snapshot(archive)
+        if snapshot is None:
+            raise ValueError(f'\'{archive}\' has no snapshot, its chain can\'t be restored')
+        chain.append((archive, snapshot))
+        if snapshot['base'] is None:
+            return chain
+        archive = os.path.join(os.path.dirname(archive), snapshot['base'])
+
+
+# Which archive of a chain to read each file of the latest state from: the
+# newest one that holds it. Directories all come from the newest archive,
+# which holds every one of them. Files deleted on the way are in no plan
+def plan_chain_restore(chain):
+    files = chain[0][1]['files']
+    remaining = {name for name, state in files.items() if not stat.S_ISDIR(state[0])}
+    plan = []
+    for archive, snapshot in chain:
+        names = remaining.intersection(snapshot['archived'])
+        remaining -= names
+        plan.append((archive, names))
+    plan[0][1].update(name for name, state in files.items() if stat.S_ISDIR(state[0]))
+    return plan
@@ -0,0 +1,376 @@
+import os
+import sys
+import json
+import time
+import stat
+import errno
+import ctypes
+import select
+import struct
+import argparse
+from file_tree import FileEntry, DirectoryCache, DIRECTORY_CACHE_EXTENSION, scan_tree, scan_directory, walk_directory, get_matcher
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+LOCK_EXTENSION = '.lock'
+PENDING_EXTENSION = '.pending'
+FLUSH_INTERVAL = 1.0
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_DONT_FOLLOW = 0x2000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_ONLYDIR | IN_DONT_FOLLOW)
+EVENT = struct.Struct('iIII')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Watch Source Changes')
+    parser.add_argument('-s', '--source', required=True, help='Source folder to watch')
+    parser.add_argument('-j', '--journal', required=True, nargs='+', help='Journals to record changed directories in, one per backup')
+    parser.add_argument('--interval', type=float, default=FLUSH_INTERVAL, help='Seconds between journal writes')
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit()
+
+    return parser.parse_args()
+
+
+# Directories a backup has to visit, as a tree of path segments. A node is
+# 'listed' when entries directly in it changed and 'subtree' when anything
+# below it may have, e.g. a directory moved into the tree. Nodes with
+# neither only lead to changed directories below them
+class ChangeNode:
+    __slots__ = ('children', 'listed', 'subtree')
+
+    def __init__(self):
+        self.children = {}
+        self.listed = False
+        self.subtree = False
+
+    def add(self, name, subtree=False):
+        node = self
+        for segment in name.split('/') if name else ():
+            if node.subtree:
+                return
+            node = node.children.setdefault(segment, ChangeNode())
+        if subtree:
+            node.subtree = True
+            node.children = {}
+        else:
+            node.listed = True
+
+    def is_empty(self):
+        return not (self.listed or self.subtree or self.children)
+
+
+def _stat_directory(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st if stat.S_ISDIR(st.st_mode) else None
+
+
+# scan_tree limited to the changed directories: subtrees are scanned fully,
+# listed directories yield their entries and directories leading to changes
+# only yield themselves. Everything else is skipped without being listed
+def scan_changes(directory, changes, base='', include=None, exclude=None, update_dirs=False):
+    if changes.subtree:
+        yield from scan_tree(directory, base, include, exclude, update_dirs)
+        return
+    matcher = get_matcher(include, exclude)
+    if changes.listed:
+        for entry in scan_directory(directory, base, matcher):
+            if entry.is_dir:
+                child = changes.children.get(os.path.basename(entry.name))
+                children = () if child is None else scan_changes(entry.path, child, entry.name, include, exclude, update_dirs)
+                yield from walk_directory(entry, children, matcher, update_dirs)
+            else:
+                yield entry
+        return
+    for name, child in sorted(changes.children.items()):
+        s = os.path.join(base, name)
+        path = os.path.join(directory, name)
+        st = _stat_directory(path)
+        if st is None or not matcher.selects(s, True):
+            continue
+        entry = FileEntry(s, path, st, os.path.islink(path))
+        yield from walk_directory(entry, scan_changes(path, child, s, include, exclude, update_dirs), matcher, update_dirs)
+
+
+# Fallback without a watcher: directories whose mtime differs from the one
+# cached on the last run are listed, nothing was added, removed or renamed
+# in the others. Files edited in place there are missed, like --prune-dirs
+def find_changed_directories(directory, cache, changes=None, base=''):
+    if changes is None:
+        changes = ChangeNode()
+    st = _stat_directory(directory)
+    if st is None:
+        return changes
+    subdirectories = cache.get(base, st.st_mtime_ns)
+    if subdirectories is None:
+        changes.add(base.replace(os.sep, '/'))
+        subdirectories = []
+        with os.scandir(directory) as it:
+            for item in it:
+                if item.is_dir(follow_symlinks=False):
+                    subdirectories.append(item.name)
+        cache.set(base, st.st_mtime_ns, subdirectories)
+    for name in subdirectories:
+        find_changed_directories(os.path.join(directory, name), cache, changes, os.path.join(base, name))
+    return changes
+
+
+def _lock(f, operation=None):
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX if operation is None else operation)
+
+
+# Append-only log of the directories changed in a source, written by a
+# watcher and consumed by one backup. Consumed lines are kept in a pending
+# file until the backup using them finished, a failed run sees them again
+class ChangeJournal:
+    def __init__(self, path):
+        self.path = path
+        self.pending = path + PENDING_EXTENSION
+
+    # Whether a watcher of `source` holds the lock, without one the journal
+    # may be missing changes
+    def is_watched(self, source):
+        if fcntl is None:
+            return False
+        try:
+            with open(self.path + LOCK_EXTENSION, 'r') as f:
+                try:
+                    _lock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return f.read() == os.path.abspath(source)
+                return False
+        except FileNotFoundError:
+            return False
+
+    # Changes recorded since the last commit, None without a running watcher
+    def read(self, source):
+        watched = self.is_watched(source)
+        if os.path.exists(self.path):
+            with open(self.path, 'a+') as f:
+                _lock(f)
+                f.seek(0)
+                data = f.read()
+                with open(self.pending, 'a') as pending:
+                    pending.write(data)
+                    pending.flush()
+                    os.fsync(pending.fileno())
+                f.truncate(0)
+        if not watched:
+            return None
+        changes = ChangeNode()
+        try:
+            with open(self.pending, 'r') as f:
+                for line in f:
+                    try:
+                        kind, name = json.loads(line)
+                    except ValueError:
+                        continue
+                    changes.add(name, kind == 'r')
+        except FileNotFoundError:
+            pass
+        return changes
+
+    def commit(self):
+        try:
+            os.remove(self.pending)
+        except FileNotFoundError:
+            pass
+
+    def write(self, changes):
+        with open(self.path, 'a') as f:
+            _lock(f)
+            f.write(''.join(json.dumps(change, separators=(',', ':')) + '\n' for change in sorted(changes)))
+
+
+# Changes to back up from `source`: from the journal while a watcher runs,
+# from directory mtimes cached next to it otherwise. Call commit() once the
+# backup finished
+class ChangeTracker:
+    def __init__(self, source, path):
+        self.source = source
+        self.journal = ChangeJournal(path)
+        self.cache = None
+
+    def read(self):
+        changes = self.journal.read(self.source)
+        if changes is None:
+            self.cache = DirectoryCache(self.journal.path + DIRECTORY_CACHE_EXTENSION)
+            changes = find_changed_directories(self.source, self.cache)
+        return changes
+
+    def commit(self):
+        self.journal.commit()
+        if self.cache is not None:
+            self.cache.save()
+
+
+class _Inotify:
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError(f'inotify is not supported on {sys.platform}')
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.libc.inotify_rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+        self.fd = self._check(self.libc.inotify_init1(IN_CLOEXEC))
+
+    def _check(self, result):
+        if result < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        return result
+
+    def add_watch(self, path):
+        return self._check(self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK))
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    # (wd, mask, name) of the events read, waits up to `timeout` seconds
+    def read(self, timeout):
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, 65536)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+# Records the directories changed below `source` in every journal, as
+# ('d', name) for entries changed directly in a directory and ('r', name)
+# for whole subtrees. The lock is only taken once every directory is
+# watched and the first entry marks everything changed, changes made while
+# no watcher ran are unknown
+class Watcher:
+    def __init__(self, source, journals, interval=FLUSH_INTERVAL):
+        self.source = os.path.abspath(source)
+        self.journals = [ChangeJournal(path) for path in journals]
+        self.interval = interval
+        self.inotify = _Inotify()
+        self.names = {}
+        self.changes = {('r', '')}
+
+    def watch_tree(self, name):
+        path = os.path.join(self.source, *name.split('/')) if name else self.source
+        try:
+            wd = self.inotify.add_watch(path)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                print('Out of inotify watches, raise fs.inotify.max_user_watches')
+                self.changes.add(('r', ''))
+            return
+        self.names[wd] = name
+        try:
+            with os.scandir(path) as it:
+                subdirectories = [item.name for item in it if item.is_dir(follow_symlinks=False)]
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        for subdirectory in subdirectories:
+            self.watch_tree(name + '/' + subdirectory if name else subdirectory)
+
+    def unwatch_tree(self, name):
+        for wd, watched in list(self.names.items()):
+            if watched == name or watched.startswith(name + '/'):
+                self.inotify.rm_watch(wd)
+                del self.names[wd]
+
+    def handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self.changes.add(('r', ''))
+            return
+        if mask & IN_IGNORED:
+            self.names.pop(wd, None)
+            return
+        parent = self.names.get(wd)
+        if parent is None or not name:
+            return
+        self.changes.add(('d', parent))
+        child = parent + '/' + name if parent else name
+        if mask & IN_ISDIR:
+            if mask & (IN_MOVED_FROM | IN_DELETE):
+                self.unwatch_tree(child)
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                self.watch_tree(child)
+                self.changes.add(('r', child))
+
+    def flush(self):
+        if self.changes:
+            for journal in self.journals:
+                journal.write(self.changes)
+            self.changes = set()
+
+    def run(self):
+        self.watch_tree('')
+        locks = []
+        for journal in self.journals:
+            f = open(journal.path + LOCK_EXTENSION, 'a+')
+            _lock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            f.truncate(0)
+            f.write(self.source)
+            f.flush()
+            locks.append(f)
+        # Backups see the watcher from here on, everything is changed for the first
+        self.flush()
+        try:
+            flushed = time.monotonic()
+            while True:
+                for event in self.inotify.read(self.interval):
+                    self.handle(*event)
+                if time.monotonic() - flushed >= self.interval:
+                    self.flush()
+                    flushed = time.monotonic()
+        finally:
+            self.flush()
+            self.inotify.close()
+            for f in locks:
+                f.close()
+
+
+def main():
+    args = parse_args()
+    if not os.path.isdir(args.source):
+        print(f'\'{args.source}\' is not a directory')
+        sys.exit(1)
+    if fcntl is None:
+        print('Watching needs inotify and file locks, use the directory mtime fallback instead')
+        sys.exit(1)
+    try:
+        Watcher(args.source, args.journal, args.interval).run()
+    except BlockingIOError:
+        print('Another watcher is writing to the journal')
+        sys.exit(1)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+import contextlib
+import tracemalloc
+
+COUNTERS = ('files_scanned', 'files_skipped', 'files_copied', 'files_deleted', 'files_vanished', 'bytes_read', 'bytes_written')
+PHASES = ('scan', 'decide', 'copy', 'compress', 'copystat')
+PROGRESS_INTERVAL = 0.5
+
+
+# Counters and phase times of one backup, updated by the scan, check and copy
+# threads. Phase times are summed over threads, so with several workers a
+# phase can add up to more than the whole run
+class BackupStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.start = time.perf_counter()
+        self.seconds = None
+
+    def add(self, **counts):
+        with self.lock:
+            for key, value in counts.items():
+                self.counters[key] += value
+
+    def add_time(self, phase, seconds):
+        with self.lock:
+            self.phases[phase] += seconds
+
+    @contextlib.contextmanager
+    def timed(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - start)
+
+    # Count the files a scan yields and time it, time the consumer spends
+    # between entries isn't counted
+    def scan(self, entries):
+        entries = iter(entries)
+        while True:
+            start = time.perf_counter()
+            entry = next(entries, None)
+            self.add_time('scan', time.perf_counter() - start)
+            if entry is None:
+                return
+            if not entry.is_dir:
+                self.add(files_scanned=1)
+            yield entry
+
+    def stop(self):
+        self.seconds = time.perf_counter() - self.start
+
+    def to_dict(self):
+        seconds = self.seconds if self.seconds is not None else time.perf_counter() - self.start
+        return {'seconds': round(seconds, 4), **self.counters,
+                'phases': {phase: round(seconds, 4) for phase, seconds in self.phases.items()}}
+
+    def format(self):
+        return (f'{self.counters["files_scanned"]} scanned, {self.counters["files_copied"]} copied, '
+                f'{self.counters["bytes_read"] / 1048576:.1f} MB read')
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+# Calls show(status) every `interval` seconds while a backup runs. Only on
+# terminals, redirected output just gets the final state
+@contextlib.contextmanager
+def report_progress(stats, show, interval=PROGRESS_INTERVAL):
+    if not sys.stdout.isatty():
+        yield
+        return
+    stop = threading.Event()
+
+    def report():
+        while not stop.wait(interval):
+            show(stats.format())
+
+    thread = threading.Thread(target=report, name='progress', daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+# Profile everything run inside with cProfile and dump the stats to `path`
+# for pstats or snakeviz. With trace_memory the peak traced memory and the
+# largest allocation sites still alive at the end are printed to stderr
+@contextlib.contextmanager
+def profiled(path=None, trace_memory=False, limit=10):
+    profiles = []
+    if path:
+        profile = cProfile.Profile()
+        profiles.append(profile)
+        if sys.version_info < (3, 12):
+            # Before 3.12 a profiler only sees the thread that enabled it,
+            # threads started from here on get their own
+            def start_thread(frame, event, arg):
+                sys.setprofile(None)
+                thread_profile = cProfile.Profile()
+                profiles.append(thread_profile)
+                thread_profile.enable()
+            threading.setprofile(start_thread)
+        profile.enable()
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        yield
+    finally:
+        if path:
+            profile.disable()
+            threading.setprofile(None)
+            pstats.Stats(*profiles).dump_stats(path)
+        if trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f'Peak traced memory: {peak / 1048576:.1f} MB', file=sys.stderr)
+            for statistic in snapshot.statistics('lineno')[:limit]:
+                print(statistic, file=sys.stderr)
@@ -0,0 +1,204 @@
+import os
+import sys
+import stat
+import shutil
+import tarfile
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from file_tree import scan_tree, get_matcher, get_restore_path
+from copy_engine import CopyScheduler, copy_file, prefetch
+from compression import open_archive_reader
+from archive_index import restore_members, is_restored, set_metadata, get_index_path
+from chunk_store import restore_snapshot, MANIFEST_EXTENSION
+from file_index import INDEX_NAME
+from checkpoint import is_staging
+from incremental import load_chain, plan_chain_restore, get_snapshot_path
+
+SMALL_FILE_SIZE = 1024 * 1024
+# tarfile's extraction filters only exist since Python 3.12 and security releases of older ones
+FILTER_ERRORS = (ValueError, tarfile.FilterError) if hasattr(tarfile, 'data_filter') else (ValueError,)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Restore Backup')
+    parser.add_argument('-s', '--source', required=True, help='Backup to restore (mirror or version folder, archive or manifest)')
+    parser.add_argument('-d', '--destination', required=True, help='Restore destination directory')
+    parser.add_argument('-i', '--include', nargs='+', help='Files to restore (path prefixes or globs, ! negates)')
+    parser.add_argument('-e', '--exclude', nargs='+', help='Files to skip (path prefixes or globs, ! negates)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of parallel restore workers')
+    parser.add_argument('-f', '--force', action='store_true', default=False, help='Rewrite files that are already up to date')
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit()
+
+    return parser.parse_args()
+
+
+def needs_restore(path, st):
+    try:
+        target = os.lstat(path)
+    except FileNotFoundError:
+        return True
+    return not stat.S_ISREG(target.st_mode) or target.st_size != st.st_size or target.st_mtime_ns != st.st_mtime_ns
+
+
+def restore_file(source, destination, st):
+    copy_file(source, destination, st)
+    return st.st_size
+
+
+def replace_symlink(target, path):
+    if os.path.lexists(path):
+        os.remove(path)
+    os.symlink(target, path)
+
+
+# Mirror destinations and uncompressed versions are copied back through the
+# copy scheduler, directory metadata is applied once their children are done
+def restore_directory(source, target, include=None, exclude=None, jobs=1, force=False):
+    scheduler = CopyScheduler(jobs)
+    scheduler.open_directory('', None, target)
+    restored = 0
+    try:
+        for entry in prefetch(scan_tree(source, '', include, exclude, True)):
+            # The index and files left by an interrupted copy belong to the backup
+            if entry.name == INDEX_NAME or is_staging(entry.name):
+                continue
+            d = os.path.join(target, entry.name)
+            if entry.is_dir:
+                if scheduler.is_open(entry.name):
+                    scheduler.close_directory(entry.name)
+                else:
+                    scheduler.open_directory(entry.name, entry.stat, d)
+            elif entry.is_symlink and stat.S_ISLNK(entry.mode):
+                replace_symlink(os.readlink(entry.path), d)
+                restored += 1
+            elif force:
+                scheduler.submit(entry.name, restore_file, (entry.path, d, entry.stat))
+            else:
+                scheduler.submit(entry.name, restore_file, (entry.path, d, entry.stat), needs_restore, (d, entry.stat))
+    except BaseException:
+        scheduler.cancel()
+        raise
+    scheduler.wait()
+    scheduler.close_directory('')
+    return restored + sum(stats.files for stats in scheduler.worker_stats.values())
+
+
+def write_file(path, data, member):
+    with open(path, 'wb') as f:
+        f.write(data)
+    set_metadata(path, member)
+
+
+# Archives without an index can only be read in order, small files are read
+# here and written on the pool while the next members are decompressed. With
+# `names` only those members are restored
+def restore_archive(path, target, include=None, exclude=None, jobs=1, force=False, names=None):
+    matcher = get_matcher(include, exclude)
+    slots = threading.BoundedSemaphore(max(1, jobs) * 4)
+    directories = []
+    links = []
+    futures = []
+    restored = 0
+    with ThreadPoolExecutor(max_workers=max(1, jobs), thread_name_prefix='restore') as executor:
+        with open_archive_reader(path) as tar:
+            for info in tar:
+                if not matcher.selects(info.name, info.isdir()) or (names is not None and info.name not in names):
+                    continue
+                try:
+                    # Only checked, the filter would also change the restored modes
+                    if hasattr(tarfile, 'data_filter'):
+                        tarfile.data_filter(info, target)
+                    d = get_restore_path(target, info.name, info.linkname if info.issym() else None)
+                    source = get_restore_path(target, info.linkname) if info.islnk() else None
+                except FILTER_ERRORS as e:
+                    print(f'Skipping \'{info.name}\': {e}')
+                    continue
+                member = {'size': info.size, 'mode': info.mode & 0o7777, 'mtime': info.mtime}
+                if info.isdir():
+                    os.makedirs(d, exist_ok=True)
+                    directories.append((member, d))
+                    continue
+                os.makedirs(os.path.dirname(d), exist_ok=True)
+                if info.issym():
+                    replace_symlink(info.linkname, d)
+                    restored += 1
+                elif info.islnk():
+                    # Linked once the file they point to has been written
+                    links.append((source, d))
+                elif info.isreg() and (force or not is_restored(d, member)):
+                    f = tar.extractfile(info)
+                    if info.size > SMALL_FILE_SIZE:
+                        with open(d, 'wb') as out:
+                            shutil.copyfileobj(f, out, SMALL_FILE_SIZE)
+                        set_metadata(d, member)
+                    else:
+                        slots.acquire()
+                        future = executor.submit(write_file, d, f.read(), member)
+                        future.add_done_callback(lambda _: slots.release())
+                        futures.append(future)
+                    restored += 1
+        for future in futures:
+            future.result()
+    for source, d in links:
+        if os.path.exists(source):
+            if os.path.lexists(d):
+                os.remove(d)
+            os.link(source, d)
+            restored += 1
+    # Directories last so writing their children doesn't touch their mtime
+    for member, d in reversed(directories):
+        set_metadata(d, member)
+    return restored
+
+
+# Restore the latest state of an incremental chain, every file is read from
+# the newest archive holding it. Older archives first, the directories get
+# their metadata from the newest one
+def restore_chain(path, target, include=None, exclude=None, jobs=1, force=False):
+    restored = 0
+    for archive, names in reversed(plan_chain_restore(load_chain(path))):
+        if names:
+            restored += restore_archive(archive, target, include, exclude, jobs, force, names)
+    return restored
+
+
+def print_progress(header, status, is_end=False):
+    w, _ = shutil.get_terminal_size((80, 20))
+    print('\r' + header + ' ' * (w-len(status)-len(header)) + status, end='\n' if is_end else '')
+
+
+def print_restore_state(file, status, is_end=False):
+    print_progress('Restoring ' + '\'' + file + '\'', status, is_end)
+
+
+def restore(source, destination, include=None, exclude=None, jobs=1, force=False):
+    print_restore_state(source, 'WORKING')
+    if not os.path.exists(source):
+        print_restore_state(source, 'NOT FOUND', True)
+        return None
+    os.makedirs(destination, exist_ok=True)
+    if os.path.isdir(source):
+        restored = restore_directory(source, destination, include, exclude, jobs, force)
+    elif source.endswith(MANIFEST_EXTENSION):
+        restored = restore_snapshot(source, destination, include, exclude, jobs, force)
+    elif os.path.exists(get_snapshot_path(source)):
+        restored = restore_chain(source, destination, include, exclude, jobs, force)
+    elif os.path.exists(get_index_path(source)):
+        restored = restore_members(source, None, destination, jobs, include, exclude, force)
+    else:
+        restored = restore_archive(source, destination, include, exclude, jobs, force)
+    print_restore_state(source, f'{restored} FILES', True)
+    return restored
+
+
+def main():
+    args = parse_args()
+    restore(args.source, args.destination, args.include, args.exclude, args.jobs, args.force)
+
+
+if __name__ == '__main__':
+    main()
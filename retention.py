@@ -0,0 +1,224 @@
+import os
+import re
+import sys
+import json
+import shutil
+import argparse
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from archive_index import get_index_path, ARCHIVE_INDEX_EXTENSION
+from chunk_store import collect_garbage, MANIFEST_EXTENSION
+from checkpoint import is_partial
+from incremental import get_snapshot_path, load_snapshot, SNAPSHOT_EXTENSION
+
+CATALOG_EXTENSION = '.catalog'
+# Periods of the retention tiers, versions taken in the same period share a key
+TIERS = (
+    ('hourly', '%Y-%m-%d %H'),
+    ('daily', '%Y-%m-%d'),
+    ('weekly', '%G-%V'),
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Prune Backups')
+    parser.add_argument('-d', '--destination', required=True, help='Backup destination directory')
+    parser.add_argument('-n', '--name', required=True, help='Destination base folder Name')
+    parser.add_argument('--keep-last', type=int, default=None, help='Number of latest versions to keep')
+    parser.add_argument('--keep-hourly', type=int, default=None, help='Number of hours to keep the last version of')
+    parser.add_argument('--keep-daily', type=int, default=None, help='Number of days to keep the last version of')
+    parser.add_argument('--keep-weekly', type=int, default=None, help='Number of weeks to keep the last version of')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='Number of parallel delete workers')
+    parser.add_argument('--dry-run', action='store_true', default=False, help='Only print the versions that would be removed')
+    parser.add_argument('-l', '--list', action='store_true', default=False, help='List the versions in the catalog')
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit()
+
+    return parser.parse_args()
+
+
+def get_catalog_path(destination, basename):
+    return os.path.join(destination, '.' + basename + CATALOG_EXTENSION)
+
+
+# Versions are named '<basename>_<date>' plus an extension, so other sources
+# whose name starts with the basename never match
+def get_version_pattern(basename):
+    return re.compile(re.escape(basename) + r'_\d{4}_\d{2}_\d{2}_\d{6}')
+
+
+def is_version(pattern, item):
+    return pattern.match(item) is not None and not is_partial(item) and not item.endswith((ARCHIVE_INDEX_EXTENSION, SNAPSHOT_EXTENSION))
+
+
+def get_version_type(path):
+    if path.endswith(MANIFEST_EXTENSION):
+        return 'manifest'
+    return 'dir' if os.path.isdir(path) else 'archive'
+
+
+# Versions of one source in a destination, oldest first, with the time the
+# scan of each started and the archive an incremental one is based on.
+# Backups look up the latest version and prune old ones here instead of
+# listing and statting the destination. Rebuilt from the listing when missing, e.g. for
+# destinations written before catalogs existed
+class VersionCatalog:
+    def __init__(self, destination, basename):
+        self.destination = destination
+        self.basename = basename
+        self.path = get_catalog_path(destination, basename)
+        self.versions = []
+        # Removed from the catalog but not deleted yet, finished by the next prune
+        self.pruning = []
+        try:
+            with open(self.path, 'r') as f:
+                catalog = json.load(f)
+            self.versions = catalog['versions']
+            self.pruning = catalog['pruning']
+        except (FileNotFoundError, ValueError, KeyError):
+            if os.path.isdir(destination):
+                self.versions = self.scan()
+                self.save()
+
+    def scan(self):
+        pattern = get_version_pattern(self.basename)
+        versions = []
+        for item in os.listdir(self.destination):
+            if is_version(pattern, item) and item not in self.pruning:
+                path = os.path.join(self.destination, item)
+                version = {'name': item, 'type': get_version_type(path), 'time': os.path.getctime(path)}
+                snapshot = load_snapshot(path) if version['type'] == 'archive' else None
+                if snapshot and snapshot['base']:
+                    version['base'] = snapshot['base']
+                versions.append(version)
+        return sorted(versions, key=lambda version: version['time'])
+
+    def get_path(self, version):
+        return os.path.join(self.destination, version['name'])
+
+    def get_latest(self, kind=None):
+        versions = [version for version in self.versions if kind is None or version['type'] == kind]
+        if not versions:
+            return None
+        if not os.path.exists(self.get_path(versions[-1])):
+            # Deleted by hand, the listing is the truth
+            self.versions = self.scan()
+            self.save()
+            return self.get_latest(kind)
+        return versions[-1]
+
+    def add(self, name, kind, time, base=None):
+        self.versions = [version for version in self.versions if version['name'] != name]
+        version = {'name': name, 'type': kind, 'time': time}
+        if base:
+            version['base'] = base
+        self.versions.append(version)
+
+    def save(self):
+        catalog = {'format': 1, 'versions': self.versions, 'pruning': self.pruning}
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(catalog, f, separators=(',', ':'))
+        os.replace(self.path + '.tmp', self.path)
+
+
+# How many versions to keep: the `last` newest ones and the newest one of
+# each of the latest `hourly` hours, `daily` days and `weekly` weeks that
+# have versions. The newest version of each type is always kept, the next
+# backup links or deduplicates against it
+class RetentionPolicy:
+    __slots__ = ('last', 'hourly', 'daily', 'weekly')
+
+    def __init__(self, last=None, hourly=None, daily=None, weekly=None):
+        self.last = last or 0
+        self.hourly = hourly or 0
+        self.daily = daily or 0
+        self.weekly = weekly or 0
+
+    def is_set(self):
+        return any((self.last, self.hourly, self.daily, self.weekly))
+
+    def keep(self, versions):
+        newest = sorted(versions, key=lambda version: version['time'], reverse=True)
+        kept = {version['name'] for version in newest[:self.last]}
+        types = set()
+        for version in newest:
+            if version['type'] not in types:
+                types.add(version['type'])
+                kept.add(version['name'])
+        for tier, period in TIERS:
+            count = getattr(self, tier)
+            periods = set()
+            for version in newest:
+                if len(periods) >= count:
+                    break
+                key = datetime.fromtimestamp(version['time']).strftime(period)
+                if key not in periods:
+                    periods.add(key)
+                    kept.add(version['name'])
+        return kept
+
+
+def remove_version(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+    for sidecar in (get_index_path(path), get_snapshot_path(path)):
+        if os.path.exists(sidecar):
+            os.remove(sidecar)
+
+
+# Versions the policy doesn't keep are dropped from the catalog before they
+# are deleted, so an interrupted prune never leaves a half deleted version
+# in it, then deleted on `jobs` threads. Archives kept increments are based
+# on are kept too. Chunks only the removed manifests referred to are
+# collected afterwards
+def prune(destination, basename, policy, jobs=4, dry_run=False, catalog=None):
+    if catalog is None:
+        catalog = VersionCatalog(destination, basename)
+    kept = policy.keep(catalog.versions)
+    bases = {version['name']: version.get('base') for version in catalog.versions}
+    for name in list(kept):
+        while bases.get(name):
+            name = bases[name]
+            kept.add(name)
+    removed = [version for version in catalog.versions if version['name'] not in kept]
+    if dry_run:
+        return removed
+    if removed:
+        catalog.versions = [version for version in catalog.versions if version['name'] in kept]
+        catalog.pruning += [version['name'] for version in removed]
+        catalog.save()
+    if catalog.pruning:
+        with ThreadPoolExecutor(max_workers=max(1, jobs), thread_name_prefix='prune') as executor:
+            list(executor.map(remove_version, [os.path.join(destination, name) for name in catalog.pruning]))
+        if any(name.endswith(MANIFEST_EXTENSION) for name in catalog.pruning):
+            collect_garbage(destination)
+        catalog.pruning = []
+        catalog.save()
+    return removed
+
+
+def main():
+    args = parse_args()
+    if not os.path.isdir(args.destination):
+        print(f'\'{args.destination}\' is not a directory')
+        sys.exit(1)
+    catalog = VersionCatalog(args.destination, args.name)
+    if args.list:
+        for version in catalog.versions:
+            print(datetime.fromtimestamp(version['time']).strftime('%Y-%m-%d %H:%M:%S'), version['type'], version['name'])
+        return
+    policy = RetentionPolicy(args.keep_last, args.keep_hourly, args.keep_daily, args.keep_weekly)
+    if not policy.is_set():
+        print('No retention policy given, nothing to prune')
+        sys.exit(1)
+    removed = prune(args.destination, args.name, policy, args.jobs, args.dry_run, catalog)
+    for version in removed:
+        print(('Would remove ' if args.dry_run else 'Removed ') + version['name'])
+
+
+if __name__ == '__main__':
+    main()
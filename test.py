@@ -1,9 +1,26 @@
+import io
 import os
+import json
+import random
 import time
+import datetime
 import shutil
+import stat
 import tarfile
 import backup
 import backup_version
+import backup_jobs
+import chunk_store
+import copy_engine
+import checksum
+import archive_index
+import restore
+import retention
+import metrics
+import incremental
+import throttle
+import file_tree
+import journal
 
 test_dir = 'test'
 dir_name = 'project'
@@ -29,6 +46,23 @@ def read_file(file_name):
     return text
 
 
+def write_bytes(path, data):
+    f = open(path, 'wb')
+    f.write(data)
+    f.close()
+
+
+def read_path(path):
+    f = open(path, 'r')
+    text = f.read()
+    f.close()
+    return text
+
+
+def count_files(directory):
+    return sum(len(files) for _, _, files in os.walk(directory))
+
+
 def mkdir(directory_name):
     os.mkdir(os.path.join(from_dir, directory_name))
 
@@ -41,6 +75,11 @@ def delete_file(file_name):
         os.remove(file_name)
 
 
+def get_latest_version(destination):
+    latest = retention.VersionCatalog(destination, dir_name).get_latest()
+    return latest['name'] if latest else None
+
+
 def get_tar_members(file_name):
     f = tarfile.open(os.path.join(to_dir, file_name), 'r')
     members = f.getnames()
@@ -175,6 +214,249 @@ def version_name_existing():
     return not b1 and b2 and os.path.exists(b2)
 
 
+# Support compressing projects on multiple workers
+def version_compress_jobs():
+    b = backup_version.backup(from_dir, to_dir, compress=True, force=True, jobs=2)
+    f = tarfile.open(b, 'r:gz')
+    members = f.getnames()
+    text = f.extractfile('1.txt').read()
+    f.close()
+    return b and '1.txt' in members and 'folder/a.txt' in members and text == b'7'
+
+
+# Support deduplicated snapshots that can be restored
+def version_dedup():
+    dedup_dir = to_dir + '_dedup'
+    restore_dir = to_dir + '_restore'
+    big_text = ''.join(str(i) for i in range(100000))
+    write_file('big.txt', big_text)
+    b1 = backup_version.backup(from_dir, dedup_dir, dedup=True)
+    chunks = count_files(os.path.join(dedup_dir, chunk_store.CHUNKS_NAME))
+    tick()
+    write_file('1.txt', '8')
+    b2 = backup_version.backup(from_dir, dedup_dir, dedup=True)
+    new_chunks = count_files(os.path.join(dedup_dir, chunk_store.CHUNKS_NAME))
+    chunk_store.restore_snapshot(b2, restore_dir)
+    delete_file('big.txt')
+    return b1 and b2 and b2.endswith('.manifest') and \
+        new_chunks == chunks + 1 and \
+        read_path(os.path.join(restore_dir, '1.txt')) == '8' and \
+        read_path(os.path.join(restore_dir, 'big.txt')) == big_text and \
+        os.stat(os.path.join(restore_dir, 'folder')).st_mtime == os.stat(os.path.join(from_dir, 'folder')).st_mtime
+
+
+# Support finding the same chunk boundaries as hashing byte by byte
+def version_chunk_boundaries():
+    rng = random.Random(1)
+    data = rng.randbytes(2 * 1024 * 1024) + bytes(300000)
+    expected = []
+    start = 0
+    while start < len(data):
+        end = min(len(data), start + chunk_store.MAX_CHUNK_SIZE)
+        cut = end - start
+        h = 0
+        for i in range(start + chunk_store.MIN_CHUNK_SIZE - chunk_store.WINDOW_SIZE, end):
+            h = ((h << 1) + chunk_store.GEAR[data[i]]) & 0xffffffff
+            if i >= start + chunk_store.MIN_CHUNK_SIZE and not h & chunk_store.CHUNK_MASK:
+                cut = i - start + 1
+                break
+        if end - start <= chunk_store.MIN_CHUNK_SIZE:
+            cut = end - start
+        expected.append(cut)
+        start += cut
+    return [len(chunk) for chunk in chunk_store.iter_chunks(io.BytesIO(data))] == expected
+
+
+# Support hard linking unchanged files to the previous version
+def version_link():
+    link_dir = to_dir + '_link'
+    b1 = backup_version.backup(from_dir, link_dir, compress=False, link=True)
+    tick()
+    write_file('1.txt', '9')
+    b2 = backup_version.backup(from_dir, link_dir, compress=False, link=True)
+    return b1 and b2 and \
+        os.stat(os.path.join(b1, 'folder', 'a.txt')).st_ino == os.stat(os.path.join(b2, 'folder', 'a.txt')).st_ino and \
+        os.stat(os.path.join(b1, '1.txt')).st_ino != os.stat(os.path.join(b2, '1.txt')).st_ino and \
+        read_path(os.path.join(b1, '1.txt')) == '8' and \
+        read_path(os.path.join(b2, '1.txt')) == '9'
+
+
+# Support copying files whose permissions changed instead of linking them
+def version_link_mode():
+    link_dir = to_dir + '_link_mode'
+    a = os.path.join(from_dir, 'folder', 'a.txt')
+    b1 = backup_version.backup(from_dir, link_dir, compress=False, link=True)
+    tick()
+    mode = os.stat(a).st_mode
+    os.chmod(a, 0o600)
+    write_file('1.txt', '10')
+    b2 = backup_version.backup(from_dir, link_dir, compress=False, link=True)
+    os.chmod(a, mode)
+    return b1 and b2 and \
+        os.stat(os.path.join(b1, 'folder', 'a.txt')).st_ino != os.stat(os.path.join(b2, 'folder', 'a.txt')).st_ino and \
+        os.stat(os.path.join(b1, 'folder', 'a.txt')).st_mode == mode and \
+        stat.S_IMODE(os.stat(os.path.join(b2, 'folder', 'a.txt')).st_mode) == 0o600
+
+
+# Support pruning unchanged directories while checking for changes
+def version_prune_dirs():
+    prune_dir = to_dir + '_prune'
+    b1 = backup_version.backup(from_dir, prune_dir, compress=False, prune_dirs=True)
+    tick()
+    b2 = backup_version.backup(from_dir, prune_dir, compress=False, prune_dirs=True)
+    tick()
+    write_file(os.path.join('folder', 'b.txt'), 'b')
+    b3 = backup_version.backup(from_dir, prune_dir, compress=False, prune_dirs=True)
+    return b1 and not b2 and b3 and \
+        os.path.exists(os.path.join(b3, 'folder', 'b.txt')) and \
+        os.path.exists(os.path.join(prune_dir, '.' + dir_name + file_tree.DIRECTORY_CACHE_EXTENSION))
+
+
+# Support glob and negated patterns
+def version_patterns():
+    b = backup_version.backup(from_dir, to_dir + '_patterns', include=['folder/*.txt', '!folder/b.txt'], compress=False)
+    return b and \
+        os.path.exists(os.path.join(b, 'folder', 'a.txt')) and \
+        not os.path.exists(os.path.join(b, 'folder', 'b.txt')) and \
+        os.listdir(b) == ['folder']
+
+
+# Support leaving out directories without selected entries and literal brackets
+def version_patterns_directories():
+    mkdir('build')
+    write_file(os.path.join('build', 'x.txt'), 'x')
+    write_file('lit[1].txt', 'lit')
+    include = ['**/b.txt', 'lit[1].txt']
+    b = backup_version.backup(from_dir, to_dir + '_pattern_dirs', include=include, compress=False)
+    mirror = to_dir + '_pattern_dirs_mirror'
+    backup.backup(from_dir, mirror, include=include, compress=False, low_memory=True)
+    delete_file('build')
+    delete_file('lit[1].txt')
+    return b and \
+        sorted(os.listdir(b)) == ['folder', 'lit[1].txt'] and \
+        os.listdir(os.path.join(b, 'folder')) == ['b.txt'] and \
+        sorted(os.listdir(mirror)) == ['folder', 'lit[1].txt']
+
+
+# Support copying versions on parallel workers, keeping directory times
+def version_copy_jobs():
+    b = backup_version.backup(from_dir, to_dir + '_copy_jobs', compress=False, jobs=4)
+    return b and \
+        read_path(os.path.join(b, 'folder', 'a.txt')) == read_path(os.path.join(from_dir, 'folder', 'a.txt')) and \
+        os.stat(os.path.join(b, 'folder')).st_mtime == os.stat(os.path.join(from_dir, 'folder')).st_mtime
+
+
+class Interrupted(Exception):
+    pass
+
+
+def interrupt_after(entries, count):
+    for i, entry in enumerate(entries):
+        if i == count:
+            raise Interrupted()
+        yield entry
+
+
+# Support resuming an interrupted archive from its last checkpoint
+def version_resume():
+    resume_dir = to_dir + '_resume'
+    b1 = backup_version.backup(from_dir, resume_dir, compress=True)
+    tick()
+    write_file('1.txt', '10')
+    path = os.path.join(resume_dir, os.path.basename(b1)[:-4] + '_resumed.tgz')
+    entries = list(file_tree.scan_tree(from_dir))
+    try:
+        backup_version.write_archive(interrupt_after(entries, 2), path, 'gz', None, 1, checkpoint_interval=0)
+    except Interrupted:
+        pass
+    partial = os.path.exists(path + '.partial') and \
+        get_latest_version(resume_dir) == os.path.basename(b1)
+    b2 = backup_version.backup(from_dir, resume_dir, compress=True, resume=True)
+    f = tarfile.open(b2, 'r')
+    members = f.getnames()
+    text = f.extractfile('1.txt').read()
+    f.close()
+    return partial and b2 == path and not os.path.exists(path + '.partial') and \
+        not os.path.exists(path[:-4] + '.tgz.checkpoint') and \
+        sorted(members) == sorted(entry.name for entry in entries) and text == b'10'
+
+
+# Support restoring single files from indexed archives
+def version_seekable():
+    s = os.path.join(from_dir, 'large.bin')
+    data = os.urandom(9 * 1024 * 1024)
+    write_bytes(s, data)
+    path = os.path.join(to_dir + '_seekable', 'project_2000_01_01_000000.tgz')
+    os.makedirs(os.path.dirname(path))
+    entries = list(file_tree.scan_tree(from_dir))
+    try:
+        backup_version.write_archive(interrupt_after(entries, len(entries) - 1), path, 'gz', None, 2,
+                                     checkpoint_interval=0, seekable=True)
+    except Interrupted:
+        pass
+    backup_version.write_archive(entries, path, 'gz', None, 2, True, seekable=True)
+    index = archive_index.load_index(path)
+    restore_dir = os.path.join(test_dir, 'seekable_restore')
+    restored = archive_index.restore_members(path, ['large.bin', 'folder'], restore_dir)
+    f = open(os.path.join(restore_dir, 'large.bin'), 'rb')
+    copied = f.read()
+    f.close()
+    delete_file('large.bin')
+    return len(index.blocks) > 2 and sorted(m['name'] for m in index.members) == sorted(e.name for e in entries) and \
+        restored == 1 + len(os.listdir(os.path.join(from_dir, 'folder'))) and copied == data and \
+        read_path(os.path.join(restore_dir, 'folder', 'a.txt')) == read_path(os.path.join(from_dir, 'folder', 'a.txt')) and \
+        not os.path.exists(os.path.join(restore_dir, '1.txt')) and \
+        get_latest_version(os.path.dirname(path)) == os.path.basename(path)
+
+
+# Support pruning versions by a retention policy without touching other projects
+def version_retention():
+    retention_dir = to_dir + '_retention'
+    other = backup_version.backup(from_dir, retention_dir, name='project_old', compress=True, force=True)
+    unrelated = get_latest_version(retention_dir) is None
+    b1 = backup_version.backup(from_dir, retention_dir, compress=True, force=True, seekable=True)
+    tick()
+    b2 = backup_version.backup(from_dir, retention_dir, compress=True, force=True, keep_last=1)
+    catalog = retention.VersionCatalog(retention_dir, 'project')
+    hour = 3600
+    now = datetime.datetime(2024, 1, 10, 12).timestamp()
+    versions = [{'name': str(i), 'type': 'archive', 'time': now - i * 6 * hour} for i in range(12)]
+    daily = retention.RetentionPolicy(daily=2).keep(versions)
+    last = retention.RetentionPolicy(last=2, weekly=1).keep(versions)
+    return unrelated and os.path.exists(other) and os.path.exists(b2) and not os.path.exists(b1) and \
+        not os.path.exists(b1 + '.index') and [version['name'] for version in catalog.versions] == [os.path.basename(b2)] and \
+        get_latest_version(retention_dir) == os.path.basename(b2) and \
+        daily == {'0', '3'} and last == {'0', '1'}
+
+
+# Support incremental archive chains
+def version_incremental():
+    chain_dir = to_dir + '_incremental'
+    write_file('gone.txt', 'gone')
+    b0 = backup_version.backup(from_dir, chain_dir, compress=True, force=True, incremental=True)
+    tick()
+    delete_file('gone.txt')
+    write_file('new.txt', 'new')
+    b1 = backup_version.backup(from_dir, chain_dir, compress=True, incremental=True)
+    f = tarfile.open(b1, 'r')
+    members = [member.name for member in f.getmembers() if not member.isdir()]
+    f.close()
+    snapshot = incremental.load_snapshot(b1)
+    retention.prune(chain_dir, 'project', retention.RetentionPolicy(last=1))
+    target = os.path.join(test_dir, 'incremental_restore')
+    count = restore.restore(b1, target)
+    files = [entry for entry in file_tree.scan_tree(from_dir) if not entry.is_dir]
+    restored = read_path(os.path.join(target, 'new.txt')) == 'new' and \
+        read_path(os.path.join(target, '1.txt')) == read_path(os.path.join(from_dir, '1.txt')) and \
+        not os.path.exists(os.path.join(target, 'gone.txt'))
+    tick()
+    b2 = backup_version.backup(from_dir, chain_dir, compress=True, force=True, incremental=True, full_every=1)
+    delete_file('new.txt')
+    return members == ['new.txt'] and snapshot['level'] == 1 and snapshot['deleted'] == ['gone.txt'] and \
+        os.path.exists(b0) and count == len(files) and restored and \
+        incremental.load_snapshot(b2)['level'] == 0
+
+
 def test_version():
     if os.path.exists(f'{test_dir}'):
         shutil.rmtree(f'{test_dir}')
@@ -191,7 +473,20 @@ def test_version():
             ('compress exclude', version_compress_exclude),
             ('force', version_force),
             ('name new', version_name_new),
-            ('name existing', version_name_existing)
+            ('name existing', version_name_existing),
+            ('compress jobs', version_compress_jobs),
+            ('dedup', version_dedup),
+            ('link', version_link),
+            ('link mode', version_link_mode),
+            ('prune dirs', version_prune_dirs),
+            ('patterns', version_patterns),
+            ('patterns directories', version_patterns_directories),
+            ('copy jobs', version_copy_jobs),
+            ('resume', version_resume),
+            ('seekable', version_seekable),
+            ('retention', version_retention),
+            ('incremental', version_incremental),
+            ('chunk boundaries', version_chunk_boundaries)
         ]
         for test in tests:
             if not test[1]():
@@ -338,6 +633,406 @@ def default_file_force():
         os.stat(os.path.join(from_dir, 'a.txt')).st_mtime == os.stat(os.path.join(to_dir, 'a.tgz')).st_mtime
 
 
+# Support copying files in parallel
+def default_dir_jobs():
+    jobs_dir = to_dir + '_jobs'
+    for i in range(3):
+        mkdir(f'jobs{i}')
+        for j in range(5):
+            write_file(os.path.join(f'jobs{i}', f'{j}.txt'), str(j))
+    backup.backup(from_dir, jobs_dir, compress=False, jobs=4)
+    for root, dirs, files in os.walk(from_dir):
+        for item in dirs + files:
+            s = os.path.join(root, item)
+            d = os.path.join(jobs_dir, os.path.relpath(s, from_dir))
+            if not os.path.exists(d) or os.stat(s).st_mtime != os.stat(d).st_mtime:
+                return False
+    return os.stat(from_dir).st_mtime == os.stat(jobs_dir).st_mtime
+
+
+# Support detecting changes through a destination index
+def default_dir_index():
+    index_dir = to_dir + '_index'
+    backup.backup(from_dir, index_dir, compress=False, use_index=True)
+    os.remove(os.path.join(index_dir, '1.txt'))
+    backup.backup(from_dir, index_dir, compress=False, use_index=True)
+    missing = not os.path.exists(os.path.join(index_dir, '1.txt'))
+    write_file('1.txt', 'index')
+    backup.backup(from_dir, index_dir, compress=False, use_index=True)
+    f = open(os.path.join(index_dir, '1.txt'), 'r')
+    text = f.read()
+    f.close()
+    return missing and text == 'index' and \
+        os.path.exists(os.path.join(index_dir, backup.INDEX_NAME))
+
+
+# Support choosing the compression codec
+def default_dir_codec():
+    codec_dir = to_dir + '_codec'
+    backup.backup(from_dir, codec_dir, compress=True, codec='xz', level=1)
+    backup.backup(from_dir, codec_dir, compress=True, codec='gz')
+    f = tarfile.open(os.path.join(codec_dir, dir_name + '.txz'), 'r:xz')
+    members = f.getnames()
+    f.close()
+    f = open(os.path.join(codec_dir, dir_name + '.tgz'), 'rb')
+    magic = f.read(2)
+    f.close()
+    return '1.txt' in members and 'jobs0/0.txt' in members and magic == b'\x1f\x8b'
+
+
+# Support rewriting only the changed blocks of large files
+def default_dir_delta():
+    delta_dir = to_dir + '_delta'
+    s = os.path.join(from_dir, 'image.bin')
+    d = os.path.join(delta_dir, 'image.bin')
+    data = bytearray(os.urandom(3 * 1024 * 1024))
+    write_bytes(s, data)
+    backup.backup(from_dir, delta_dir, compress=False, delta=True, delta_min_size=0)
+    tick()
+    data[1024 * 1024 + 5] ^= 0xff
+    del data[2 * 1024 * 1024:]
+    write_bytes(s, data)
+    backup.backup(from_dir, delta_dir, compress=False, delta=True, delta_min_size=0)
+    f = open(d, 'rb')
+    copied = f.read()
+    f.close()
+    data[5] ^= 0xff
+    write_bytes(s, data)
+    written = copy_engine.delta_copy(s, d, os.stat(s))
+    delete_file('image.bin')
+    return copied == bytes(data[:5]) + bytes([data[5] ^ 0xff]) + bytes(data[6:]) and \
+        written == 1024 * 1024 and os.path.getsize(d) == 2 * 1024 * 1024
+
+
+# Properly remove deleted directories in parallel
+def default_dir_trees_jobs():
+    trees_dir = to_dir + '_trees'
+    mkdir('old')
+    mkdir(os.path.join('old', 'deep'))
+    write_file(os.path.join('old', 'deep', 'x.txt'), 'x')
+    write_file('replaced', 'file')
+    backup.backup(from_dir, trees_dir, compress=False, compare_trees=True, jobs=2)
+    existed = os.path.exists(os.path.join(trees_dir, 'old', 'deep', 'x.txt'))
+    delete_file('old')
+    delete_file('replaced')
+    mkdir('replaced')
+    backup.backup(from_dir, trees_dir, compress=False, compare_trees=True, jobs=2)
+    delete_file('replaced')
+    return existed and not os.path.exists(os.path.join(trees_dir, 'old')) and \
+        os.path.isdir(os.path.join(trees_dir, 'replaced')) and \
+        os.path.exists(os.path.join(trees_dir, '1.txt'))
+
+
+# Properly copy sparse files, keeping their holes, with and without kernel copies
+def default_dir_sparse():
+    sparse_dir = to_dir + '_sparse'
+    s = os.path.join(from_dir, 'disk.img')
+    f = open(s, 'wb')
+    f.write(b'head')
+    f.seek(16 * 1024 * 1024)
+    f.write(b'middle')
+    f.truncate(32 * 1024 * 1024)
+    f.close()
+    backup.backup(from_dir, sparse_dir, compress=False)
+    d = os.path.join(sparse_dir, 'disk.img')
+    copied = read_path(d) == read_path(s)
+    sparse = os.stat(d).st_blocks * 512 < os.path.getsize(d) if copy_engine.is_sparse(os.stat(s)) else True
+    plain = os.path.join(sparse_dir, 'plain.img')
+    unsupported = set(copy_engine._unsupported)
+    devices = (os.stat(s).st_dev, os.stat(sparse_dir).st_dev)
+    copy_engine._unsupported.update((copy,) + devices for copy in [copy_engine._clone] + copy_engine.KERNEL_COPIES)
+    try:
+        copy_engine.copy_file(s, plain, os.stat(s))
+    finally:
+        copy_engine._unsupported.clear()
+        copy_engine._unsupported.update(unsupported)
+    delete_file('disk.img')
+    return copied and sparse and read_path(plain) == read_path(d) and \
+        os.path.getsize(plain) == 32 * 1024 * 1024
+
+
+# Support running several jobs from a job file
+def default_dir_jobs_file():
+    jobs_file = os.path.join(test_dir, 'jobs.json')
+    f = open(jobs_file, 'w')
+    json.dump({'defaults': {'include': ['1.txt', 'folder']}, 'parallel': 2, 'jobs': [
+        {'job': 'mirror', 'source': from_dir, 'destination': to_dir + '_job_mirror', 'index': True},
+        {'job': 'version', 'type': 'version', 'source': from_dir, 'destination': to_dir + '_job_version',
+         'prune_dirs': True},
+    ]}, f)
+    f.close()
+    jobs, parallel, device_jobs = backup_jobs.load_jobs(jobs_file)
+    failed = backup_jobs.JobRunner(parallel, device_jobs).run(jobs)
+    versions = [item for item in os.listdir(to_dir + '_job_version') if not item.startswith('.')]
+    return not failed and parallel == 2 and \
+        read_path(os.path.join(to_dir + '_job_mirror', '1.txt')) == read_path(os.path.join(from_dir, '1.txt')) and \
+        os.path.exists(os.path.join(to_dir + '_job_mirror', '.backup_index.sqlite')) and \
+        not os.path.exists(os.path.join(to_dir + '_job_mirror', 'jobs0')) and \
+        len(versions) == 1
+
+
+# Support detecting changes by content and verifying destinations and archives
+def default_dir_checksum():
+    checksum_dir = to_dir + '_checksum'
+    s = os.path.join(from_dir, 'same.txt')
+    d = os.path.join(checksum_dir, 'same.txt')
+    write_bytes(s, b'same')
+    backup.backup(from_dir, checksum_dir, compress=False, checksum=True)
+    inode = os.stat(d).st_ino
+    st = os.stat(s)
+    # Touched but identical
+    os.utime(s, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 10))
+    backup.backup(from_dir, checksum_dir, compress=False, checksum=True)
+    touched = os.stat(d).st_ino == inode and os.stat(d).st_mtime_ns == st.st_mtime_ns + 10 ** 10
+    # Same size and mtime as the destination, older than it
+    write_bytes(s, b'diff')
+    os.utime(s, ns=(st.st_atime_ns, st.st_mtime_ns))
+    backup.backup(from_dir, checksum_dir, compress=False, checksum=True)
+    copied = read_path(d) == 'diff'
+    verified = checksum.verify_destination(checksum_dir) == []
+    write_bytes(d, b'rot!')
+    corrupt = checksum.verify_destination(checksum_dir, 2) == [('same.txt', 'CORRUPT')]
+    archive = backup_version.backup(from_dir, to_dir + '_checksum_archive', compress=True)
+    archived = checksum.verify_archive(archive, from_dir) == []
+    write_bytes(s, b'changed')
+    changed = checksum.verify_archive(archive, from_dir) == [('same.txt', 'DIFFERENT')]
+    delete_file('same.txt')
+    return touched and copied and verified and corrupt and archived and changed
+
+
+# Support restoring mirrors, archives and snapshots incrementally
+def default_dir_restore():
+    restore_dir = os.path.join(test_dir, 'restore')
+    mirror_dir = to_dir + '_restore'
+    os.makedirs(os.path.join(from_dir, 'folder'), exist_ok=True)
+    write_file(os.path.join('folder', 'r.txt'), 'restore')
+    backup.backup(from_dir, mirror_dir, compress=False, use_index=True)
+    first = restore.restore(mirror_dir, restore_dir, include=['folder'], jobs=2)
+    selected = not os.path.exists(os.path.join(restore_dir, '1.txt')) and \
+        not os.path.exists(os.path.join(restore_dir, '.backup_index.sqlite')) and \
+        os.stat(os.path.join(restore_dir, 'folder')).st_mtime == os.stat(os.path.join(from_dir, 'folder')).st_mtime
+    write_bytes(os.path.join(restore_dir, 'folder', 'r.txt'), b'changed')
+    second = restore.restore(mirror_dir, restore_dir, include=['folder'], jobs=2)
+    restored = read_path(os.path.join(restore_dir, 'folder', 'r.txt')) == read_path(os.path.join(from_dir, 'folder', 'r.txt'))
+    results = []
+    for options in ({'compress': True}, {'compress': True, 'seekable': True}, {'dedup': True}):
+        target = os.path.join(test_dir, 'restore_' + '_'.join(options))
+        b = backup_version.backup(from_dir, to_dir + '_restore_' + '_'.join(options), force=True, **options)
+        count = restore.restore(b, target, exclude=['1.txt'], jobs=2)
+        again = restore.restore(b, target, exclude=['1.txt'], jobs=2)
+        results.append(count > 0 and again == 0 and not os.path.exists(os.path.join(target, '1.txt')) and
+                       read_path(os.path.join(target, 'folder', 'r.txt')) == read_path(os.path.join(from_dir, 'folder', 'r.txt')))
+    return first == len(os.listdir(os.path.join(from_dir, 'folder'))) and selected and second == 1 and restored and all(results)
+
+
+# Support counting files and bytes of a backup
+def default_dir_stats():
+    stats_dir = to_dir + '_stats'
+    write_file('stats.txt', 'stats')
+    first = metrics.BackupStats()
+    backup.backup(from_dir, stats_dir, compress=False, jobs=2, stats=first)
+    second = metrics.BackupStats()
+    backup.backup(from_dir, stats_dir, compress=False, jobs=2, stats=second)
+    files = [entry for entry in backup.scan_tree(from_dir) if not entry.is_dir]
+    result = first.to_dict()
+    return result['files_scanned'] == len(files) and result['files_copied'] == len(files) and \
+        result['bytes_written'] == sum(entry.size for entry in files) and result['seconds'] > 0 and \
+        second.counters['files_skipped'] == len(files) and second.counters['files_copied'] == 0
+
+
+# Support limiting the bandwidth and file rate of backups
+def default_dir_throttle():
+    throttle_dir = to_dir + '_throttle'
+    os.makedirs(os.path.join(from_dir, 'throttle'), exist_ok=True)
+    with open(os.path.join(from_dir, 'throttle', 'big.bin'), 'wb') as f:
+        f.write(os.urandom(3 * 1048576))
+    limiter = throttle.Throttle(bytes_per_second=1048576)
+    start = time.monotonic()
+    with throttle.throttled(limiter):
+        backup.backup(os.path.join(from_dir, 'throttle'), throttle_dir, compress=False, jobs=2)
+    seconds = time.monotonic() - start
+    # A latency above the limit halves the rate, once per interval
+    adaptive = throttle.Throttle(bytes_per_second=8 * 1048576, max_latency=0.01)
+    adaptive.adjusted -= throttle.ADJUST_INTERVAL
+    adaptive.observe(0.1)
+    backed_off = adaptive.rate
+    adaptive.adjusted -= throttle.ADJUST_INTERVAL
+    adaptive.observe(0.001)
+    shutil.rmtree(os.path.join(from_dir, 'throttle'))
+    return seconds >= 1.5 and throttle.get_throttle() is None and \
+        backed_off == 4 * 1048576 and adaptive.rate == 5 * 1048576
+
+
+# Support bounded-memory scans of huge directories
+def default_dir_low_memory():
+    low_memory_dir = to_dir + '_low_memory'
+    flat = os.path.join(from_dir, 'flat')
+    os.makedirs(flat, exist_ok=True)
+    for i in range(10):
+        write_file(os.path.join('flat', f'f{9 - i}.txt'), str(i))
+    # Spilled in runs of 3 and merged
+    names = [item.name for item in file_tree.iter_sorted_directory(flat, spill_threshold=3)]
+    scanned = sorted(entry.name for entry in file_tree.scan_tree_sorted(from_dir, spill_threshold=3))
+    expected = sorted(entry.name for entry in file_tree.scan_tree(from_dir))
+    backup.backup(from_dir, low_memory_dir, low_memory=True)
+    backup.backup(from_dir, low_memory_dir, compress=True, low_memory=True)
+    with tarfile.open(os.path.join(low_memory_dir, dir_name + '.tgz')) as tar:
+        archived = tar.getnames()
+    copied = os.listdir(os.path.join(low_memory_dir, 'flat'))
+    shutil.rmtree(flat)
+    return names == sorted(f'f{i}.txt' for i in range(10)) and len(copied) == 10 and \
+        scanned == expected and 'flat/f0.txt' in archived
+
+
+# Support scanning only the directories recorded as changed
+def default_dir_journal():
+    journal_dir = to_dir + '_journal'
+    journal_path = os.path.join(test_dir, 'project.journal')
+    os.makedirs(os.path.join(from_dir, 'watched'), exist_ok=True)
+    write_file(os.path.join('watched', 'w.txt'), 'watched')
+    # No watcher runs, directories with an unchanged mtime aren't listed
+    first = metrics.BackupStats()
+    backup.backup(from_dir, journal_dir, stats=first, journal=journal_path)
+    second = metrics.BackupStats()
+    backup.backup(from_dir, journal_dir, stats=second, journal=journal_path)
+    tick()
+    write_file(os.path.join('watched', 'x.txt'), 'new')
+    third = metrics.BackupStats()
+    backup.backup(from_dir, journal_dir, stats=third, journal=journal_path)
+    watched = True
+    if journal.fcntl is not None and journal.sys.platform.startswith('linux'):
+        watcher = journal.Watcher(from_dir, [journal_path])
+        watcher.watch_tree('')
+        write_file(os.path.join('watched', 'y.txt'), 'event')
+        for event in watcher.inotify.read(1):
+            watcher.handle(*event)
+        watcher.inotify.close()
+        watched = ('d', 'watched') in watcher.changes
+    shutil.rmtree(os.path.join(from_dir, 'watched'))
+    return first.counters['files_copied'] == first.counters['files_scanned'] and \
+        second.counters['files_scanned'] == 0 and third.counters['files_copied'] == 1 and \
+        os.path.exists(os.path.join(journal_dir, 'watched', 'x.txt')) and watched
+
+
+# Support scan errors not being hidden by errors of the copy workers
+def default_dir_scan_error():
+    prefetch = backup.prefetch
+    copy_entry = backup.copy_entry
+
+    def failing_prefetch(entries):
+        yield from prefetch(entries)
+        time.sleep(0.5)
+        raise KeyboardInterrupt()
+
+    def failing_copy_entry(*args):
+        raise ValueError()
+
+    backup.prefetch = failing_prefetch
+    backup.copy_entry = failing_copy_entry
+    try:
+        backup.backup(from_dir, to_dir + '_scan_error', force=True)
+    except KeyboardInterrupt:
+        return True
+    except ValueError:
+        return False
+    finally:
+        backup.prefetch = prefetch
+        backup.copy_entry = copy_entry
+    return False
+
+
+# Support files deleted between the scan and their copy
+def default_dir_vanished():
+    vanished_dir = to_dir + '_vanished'
+    write_file('vanished.txt', 'gone')
+    entries = [entry for entry in backup.scan_tree(from_dir) if entry.name == 'vanished.txt']
+    os.remove(os.path.join(from_dir, 'vanished.txt'))
+    os.makedirs(vanished_dir, exist_ok=True)
+    stats = metrics.BackupStats()
+    copied = backup.copy_entry(entries[0], os.path.join(vanished_dir, 'vanished.txt'), stats=stats)
+    versioned = backup_version.copy_entry(entries[0], os.path.join(vanished_dir, 'versioned.txt'), stats=stats)
+    return copied is None and versioned is None and stats.counters['files_vanished'] == 2 and \
+        not os.path.exists(os.path.join(vanished_dir, 'vanished.txt'))
+
+
+# Support dangling symlinks, copied as links
+def default_dir_dangling_symlink():
+    dangling_dir = to_dir + '_dangling'
+    link = os.path.join(from_dir, 'dangling.txt')
+    os.symlink('missing.txt', link)
+    backup.backup(from_dir, dangling_dir)
+    backup.backup(from_dir, dangling_dir)
+    version = backup_version.backup(from_dir, dangling_dir + '_version', compress=False)
+    os.remove(link)
+    copied = os.path.join(dangling_dir, 'dangling.txt')
+    versioned = os.path.join(version, 'dangling.txt')
+    return os.path.islink(copied) and os.readlink(copied) == 'missing.txt' and \
+        os.path.islink(versioned) and os.readlink(versioned) == 'missing.txt'
+
+
+# Support source files named like a staged copy
+def default_dir_partial_names():
+    partial_dir = to_dir + '_partial_names'
+    restore_dir = partial_dir + '_restored'
+    write_file('p.txt', 'p')
+    write_file('p.txt.partial', 'user')
+    backup.backup(from_dir, partial_dir)
+    backup.backup(from_dir, partial_dir)
+    restore.restore(partial_dir, restore_dir)
+    delete_file('p.txt')
+    delete_file('p.txt.partial')
+    return read_path(os.path.join(partial_dir, 'p.txt.partial')) == 'user' and \
+        read_path(os.path.join(restore_dir, 'p.txt.partial')) == 'user' and \
+        read_path(os.path.join(restore_dir, 'p.txt')) == 'p'
+
+
+# Support interrupted archives being written again by the next run
+def default_dir_compress_interrupted():
+    interrupted_dir = to_dir + '_interrupted'
+    add_to_tar = backup.add_to_tar
+
+    def failing_add_to_tar(tar, entry):
+        raise KeyboardInterrupt()
+
+    backup.add_to_tar = failing_add_to_tar
+    try:
+        backup.backup(from_dir, interrupted_dir, compress=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        backup.add_to_tar = add_to_tar
+    left = os.listdir(interrupted_dir)
+    backup.backup(from_dir, interrupted_dir, compress=True)
+    members = tarfile.open(os.path.join(interrupted_dir, dir_name + '.tgz'), 'r').getnames()
+    return left == [] and '1.txt' in members
+
+
+# Support rejecting archive members restored outside the destination
+def default_dir_restore_traversal():
+    archive = os.path.join(test_dir, 'traversal.tar')
+    target = os.path.join(test_dir, 'traversal', 'restored')
+    with tarfile.open(archive, 'w') as tar:
+        for name, data in (('../evil', b'evil'), ('link/evil', b'evil'), ('good.txt', b'good')):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+            if name == '../evil':
+                info = tarfile.TarInfo('link')
+                info.type = tarfile.SYMTYPE
+                info.linkname = '..'
+                tar.addfile(info)
+    restore.restore_archive(archive, target)
+    with open(os.path.join(target, 'good.txt'), 'rb') as f:
+        good = f.read() == b'good'
+    try:
+        file_tree.get_restore_path(target, 'link', '../..')
+        return False
+    except ValueError:
+        pass
+    return good and os.listdir(os.path.dirname(target)) == ['restored'] and \
+        not os.path.islink(os.path.join(target, 'link'))
+
+
 def test_default():
     if os.path.exists(f'{test_dir}'):
         shutil.rmtree(f'{test_dir}')
@@ -357,7 +1052,26 @@ def test_default():
             ('file new', default_file_new),
             ('file existing', default_file_existing),
             ('file compress', default_file_compress),
-            ('file force', default_file_force)
+            ('file force', default_file_force),
+            ('dir jobs', default_dir_jobs),
+            ('dir index', default_dir_index),
+            ('dir codec', default_dir_codec),
+            ('dir delta', default_dir_delta),
+            ('dir trees jobs', default_dir_trees_jobs),
+            ('dir sparse', default_dir_sparse),
+            ('dir jobs file', default_dir_jobs_file),
+            ('dir checksum', default_dir_checksum),
+            ('dir restore', default_dir_restore),
+            ('dir stats', default_dir_stats),
+            ('dir throttle', default_dir_throttle),
+            ('dir low memory', default_dir_low_memory),
+            ('dir journal', default_dir_journal),
+            ('dir scan error', default_dir_scan_error),
+            ('dir vanished', default_dir_vanished),
+            ('dir dangling symlink', default_dir_dangling_symlink),
+            ('dir partial names', default_dir_partial_names),
+            ('dir compress interrupted', default_dir_compress_interrupted),
+            ('dir restore traversal', default_dir_restore_traversal)
         ]
         for test in tests:
             if not test[1]():
@@ -0,0 +1,173 @@
+import os
+import sys
+import time
+import ctypes
+import platform
+import threading
+import contextlib
+
+MIN_RATE = 1024 * 1024
+# Rate factors applied when latency goes above or stays below the limit
+BACKOFF = 0.5
+RECOVERY = 1.25
+ADJUST_INTERVAL = 1.0
+IOPRIO_CLASSES = {'best-effort': 2, 'idle': 3}
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+# ioprio_set isn't wrapped by the os module
+IOPRIO_SET = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'armv7l': 314}
+
+# Throttle every copy and archive path in the process goes through
+_active = None
+
+
+def add_throttle_arguments(parser):
+    parser.add_argument('--bwlimit', type=float, default=None, help='Maximum MB/s read by copies and archives')
+    parser.add_argument('--files-per-second', type=float, default=None, help='Maximum number of files copied or archived per second')
+    parser.add_argument('--max-latency', type=float, default=None,
+                        help='Slow down while reads take longer than this many milliseconds')
+    parser.add_argument('--nice', type=int, default=None, help='Increment of the CPU nice value')
+    parser.add_argument('--ionice', choices=list(IOPRIO_CLASSES), default=None, help='I/O scheduling class (Linux)')
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'tokens', 'last')
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+
+    # Take `amount` tokens, going into debt when there aren't enough, and
+    # return how long to wait for the debt to be paid. Holds a second's worth
+    def take(self, amount):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+# Token buckets for bytes and files per second shared by all workers. With
+# a latency limit the byte rate adapts: once a second it is halved if a read
+# took longer than the limit, otherwise raised again up to the configured
+# rate. Without a configured rate the first backoff starts from the rate
+# seen so far and the limit is lifted once it has recovered past it
+class Throttle:
+    def __init__(self, bytes_per_second=None, files_per_second=None, max_latency=None):
+        self.lock = threading.Lock()
+        self.max_rate = bytes_per_second
+        self.bytes = TokenBucket(bytes_per_second) if bytes_per_second else None
+        self.files = TokenBucket(files_per_second) if files_per_second else None
+        self.max_latency = max_latency
+        self.start = time.monotonic()
+        self.adjusted = self.start
+        self.total = 0
+        self.worst = 0.0
+        self.unlimited_rate = None
+
+    def consume(self, size=0, files=0):
+        wait = 0.0
+        with self.lock:
+            self.total += size
+            if size and self.bytes is not None:
+                wait = self.bytes.take(size)
+            if files and self.files is not None:
+                wait = max(wait, self.files.take(files))
+        if wait > 0:
+            time.sleep(wait)
+
+    # Account for `size` bytes read in `seconds`
+    def after_io(self, size, seconds):
+        if self.max_latency is not None:
+            self.observe(seconds)
+        self.consume(size)
+
+    def observe(self, seconds):
+        with self.lock:
+            self.worst = max(self.worst, seconds)
+            now = time.monotonic()
+            if now - self.adjusted < ADJUST_INTERVAL:
+                return
+            if self.worst > self.max_latency:
+                if self.bytes is None:
+                    self.unlimited_rate = self.total / (now - self.start)
+                    self.bytes = TokenBucket(max(MIN_RATE, self.unlimited_rate * BACKOFF))
+                else:
+                    self.bytes.rate = max(MIN_RATE, self.bytes.rate * BACKOFF)
+            elif self.bytes is not None:
+                rate = self.bytes.rate * RECOVERY
+                if self.max_rate is not None:
+                    self.bytes.rate = min(rate, self.max_rate)
+                elif rate >= self.unlimited_rate:
+                    self.bytes = None
+                else:
+                    self.bytes.rate = rate
+            self.adjusted = now
+            self.worst = 0.0
+
+    @property
+    def rate(self):
+        return self.bytes.rate if self.bytes is not None else None
+
+
+# Reads through a file object, throttled
+class ThrottledReader:
+    __slots__ = ('f', 'throttle')
+
+    def __init__(self, f, throttle):
+        self.f = f
+        self.throttle = throttle
+
+    def read(self, size=-1):
+        start = time.perf_counter()
+        data = self.f.read(size)
+        self.throttle.after_io(len(data), time.perf_counter() - start)
+        return data
+
+
+def get_throttle():
+    return _active
+
+
+@contextlib.contextmanager
+def throttled(throttle):
+    global _active
+    previous = _active
+    _active = throttle
+    try:
+        yield throttle
+    finally:
+        _active = previous
+
+
+# Threads inherit the I/O priority of the thread that starts them, set it
+# before any worker is started
+def set_io_priority(name):
+    number = IOPRIO_SET.get(platform.machine())
+    if not sys.platform.startswith('linux') or number is None:
+        raise OSError(f'I/O priorities are not supported on {sys.platform} {platform.machine()}')
+    # Lowest priority within best-effort, idle has no levels
+    value = IOPRIO_CLASSES[name] << IOPRIO_CLASS_SHIFT | (7 if name == 'best-effort' else 0)
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.syscall(number, IOPRIO_WHO_PROCESS, 0, value) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+def lower_priority(nice=None, ionice=None):
+    if nice:
+        os.nice(nice)
+    if ionice:
+        try:
+            set_io_priority(ionice)
+        except OSError as e:
+            print(f'Could not set the I/O priority: {e}')
+
+
+def throttle_from_args(args):
+    lower_priority(args.nice, args.ionice)
+    if not (args.bwlimit or args.files_per_second or args.max_latency):
+        return None
+    return Throttle(args.bwlimit * 1048576 if args.bwlimit else None, args.files_per_second,
+                    args.max_latency / 1000 if args.max_latency else None)